@@ -0,0 +1,116 @@
+"""Benchmarks decode latency of each decoder on stems of several lengths.
+
+Encodes stems of pink noise with FFmpeg, then loads each of them with
+every available decoder and compares the audio to what FFmpeg decodes.
+A copy of the last stem of each format cut to its first few kilobytes
+checks that decoders hand truncated files over to FFmpeg.
+Run from the repository root:
+
+    python benchmarks/decoding.py --seconds 2,10,60 --formats ogg,mp3
+
+Written by Clysop.
+"""
+
+import os
+import sys
+import time
+import argparse
+import tempfile
+import statistics
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'src'))
+
+import numpy as np  # noqa: E402
+
+import library  # noqa: E402
+import decoders  # noqa: E402
+from audio import Audio  # noqa: E402
+
+# Bytes kept of stems cut short, about the size of Ogg Vorbis headers
+TRUNCATED_SIZE = 5000
+
+
+def load(path, filename, decoder):
+    """Returns (raw audio, seconds) of loading 'filename' with 'decoder'.
+
+    Raw audio is None if no audio could be loaded.
+    """
+    a = Audio(filename)
+    a.probe(path)
+
+    start = time.perf_counter()
+    success = a.load(path, decoder=decoder)
+    seconds = time.perf_counter() - start
+
+    return a.data if success else None, seconds
+
+
+def compare(data, reference):
+    """Returns difference in frames and max sample difference of audio."""
+    samples = np.frombuffer(data, '<i2').astype(np.int32)
+    reference = np.frombuffer(reference, '<i2').astype(np.int32)
+    length = min(len(samples), len(reference))
+    difference = np.abs(samples[:length] - reference[:length])
+    return len(samples) - len(reference), int(difference.max(initial=0))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--seconds', default='2,10,60',
+                        help='comma separated lengths of stems')
+    parser.add_argument('--formats', default='ogg,mp3')
+    parser.add_argument('--channels', type=int, default=2)
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    names = [n for n in decoders.DECODERS
+             if n == 'ffmpeg' or decoders.get_decoder(n) is not None]
+    missing = set(decoders.DECODERS) - set(names)
+    if missing:
+        print("Not available: {}\n".format(', '.join(sorted(missing))))
+
+    with tempfile.TemporaryDirectory() as path:
+        stems = []
+        for fmt in args.formats.split(','):
+            for seconds in args.seconds.split(','):
+                filename = 'stem_{}.{}'.format(seconds, fmt)
+                library.encode(os.path.join(path, filename), fmt,
+                               float(seconds), args.channels, 0.2, 0,
+                               library.FFMPEG_PATH)
+                stems.append(filename)
+
+            truncated = 'stem_cut.' + fmt
+            with open(os.path.join(path, stems[-1]), 'rb') as f:
+                head = f.read(TRUNCATED_SIZE)
+            with open(os.path.join(path, truncated), 'wb') as f:
+                f.write(head)
+            stems.append(truncated)
+
+        print("{:<16} {:<10} {:>10} {:>8} {:>10}".format(
+            'stem', 'decoder', 'latency', 'frames', 'max diff'))
+        for filename in stems:
+            reference = None
+            for name in names:
+                decoder = decoders.get_decoder(name)
+                runs = [load(path, filename, decoder)
+                        for i in range(args.repeat)]
+                data = runs[0][0]
+                latency = statistics.median(r[1] for r in runs)
+
+                # FFmpeg is the reference others are compared to.
+                if reference is None:
+                    reference = load(path, filename, None)[0]
+                if data is None or reference is None:
+                    print("{:<16} {:<10} {:>7.1f} ms {:>8} {:>10}".format(
+                        filename, name, latency * 1000, 'no audio',
+                        'ok' if data is reference else 'mismatch'))
+                    continue
+                frames, difference = compare(data, reference)
+
+                print("{:<16} {:<10} {:>7.1f} ms {:>+8} {:>10}".format(
+                    filename, name, latency * 1000,
+                    frames // args.channels, difference))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,148 @@
+"""Generates a synthetic Clone Hero library for benchmarking.
+
+Every song folder gets a notes.chart and a number of stems of pink noise,
+each at its own volume, encoded with FFmpeg. The same arguments and seed
+always give the same library, and nothing is downloaded. Run from the
+repository root:
+
+    python benchmarks/library.py bench_library/Songs --songs 50
+
+Written by Clysop.
+"""
+
+import os
+import sys
+import random
+import argparse
+import subprocess
+from concurrent.futures import ThreadPoolExecutor
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'src'))
+
+from audio import FFMPEG_PATH  # noqa: E402
+
+SAMPLE_RATE = 44100
+# Number of songs put in each pack folder, to have some nesting.
+PACK_SIZE = 20
+# Stems in the order they are added to songs, 'song' is always there.
+STEMS = ['song', 'guitar', 'rhythm', 'drums_1', 'drums_2', 'drums_3',
+         'drums_4', 'vocals', 'keys', 'crowd', 'drums']
+# FFmpeg output options by format.
+ENCODERS = {
+    'ogg': '-c:a libvorbis -q:a 4',
+    'mp3': '-c:a libmp3lame -b:a 192k',
+}
+
+CHART = """[Song]
+{{
+  Name = "Song {0}"
+  Artist = "Benchmark"
+  Resolution = 192
+}}
+[SyncTrack]
+{{
+  0 = TS 4
+  0 = B 120000
+}}
+[ExpertSingle]
+{{
+  0 = N 0 0
+}}
+"""
+
+
+def parse_range(text, kind=int):
+    """Parses 'a-b' or 'a' into a (min, max) tuple of 'kind'."""
+    low, _, high = text.partition('-')
+    return kind(low), kind(high or low)
+
+
+def generate(path, songs=20, stems=(1, 6), seconds=(30, 240), mono=0.25,
+             formats=('ogg',), seed=0, ffmpeg=FFMPEG_PATH):
+    """Generates a library of songs in 'path'.
+
+    Args:
+        path (str):         Songs folder to create.
+        songs (int):        number of songs.
+        stems (tuple):      min and max number of stems of a song.
+        seconds (tuple):    min and max length of a song in seconds.
+        mono (float):       share of stems that are mono.
+        formats (tuple):    formats songs are picked from, see ENCODERS.
+        seed (int):         seed of the random choices.
+        ffmpeg (str):       path of FFmpeg.
+
+    Returns:
+        dict: arguments the library was made with, for benchmark results.
+    """
+    rng = random.Random(seed)
+    jobs = []
+
+    for i in range(songs):
+        folder = os.path.join(path, 'pack_{}'.format(i // PACK_SIZE),
+                              'song_{}'.format(i))
+        os.makedirs(folder, exist_ok=True)
+
+        with open(os.path.join(folder, 'notes.chart'), 'w') as f:
+            f.write(CHART.format(i))
+
+        num_stems = rng.randint(*stems)
+        length = rng.uniform(*seconds)
+        fmt = rng.choice(formats)
+
+        for stem in STEMS[:num_stems]:
+            channels = 1 if rng.random() < mono else 2
+            amplitude = rng.uniform(0.02, 0.5)
+            jobs.append((os.path.join(folder, '{}.{}'.format(stem, fmt)),
+                         fmt, length, channels, amplitude,
+                         rng.randrange(2 ** 31), ffmpeg))
+
+    # Everything random is picked above, so the order stems are encoded
+    # in doesn't change the library.
+    with ThreadPoolExecutor(os.cpu_count()) as executor:
+        for i, _ in enumerate(executor.map(lambda j: encode(*j), jobs)):
+            print("Encoded {}/{} stems".format(i + 1, len(jobs)), end='\r')
+
+    print()
+    return {
+        'songs': songs,
+        'stems': list(stems),
+        'seconds': list(seconds),
+        'mono': mono,
+        'formats': list(formats),
+        'seed': seed,
+    }
+
+
+def encode(filepath, fmt, length, channels, amplitude, seed, ffmpeg):
+    """Encodes pink noise to 'filepath' using FFmpeg."""
+    source = 'anoisesrc=color=pink:amplitude={}:duration={:.2f}:' \
+             'sample_rate={}:seed={}'.format(amplitude, length, SAMPLE_RATE,
+                                             seed)
+    command = [ffmpeg, '-y', '-loglevel', 'error', '-f', 'lavfi',
+               '-i', source, '-ac', str(channels)]
+    command += ENCODERS[fmt].split() + [filepath]
+    subprocess.run(command, check=True)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('path', help='Songs folder to create')
+    parser.add_argument('--songs', type=int, default=20)
+    parser.add_argument('--stems', default='1-6',
+                        help='number of stems per song, like 3 or 1-6')
+    parser.add_argument('--seconds', default='30-240',
+                        help='length of songs, like 120 or 30-240')
+    parser.add_argument('--mono', type=float, default=0.25,
+                        help='share of stems that are mono')
+    parser.add_argument('--formats', default='ogg',
+                        help='comma separated formats, from: ogg, mp3')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    generate(args.path, args.songs, parse_range(args.stems),
+             parse_range(args.seconds, float), args.mono,
+             tuple(args.formats.split(',')), args.seed)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,100 @@
+"""Benchmarks the R128 loudness meter against FFmpeg's ebur128 filter.
+
+Measures synthetic raw audio with a quiet intro, fed to the meter in
+blocks like when streaming, and compares the result to FFmpeg measuring
+the same audio. Run from the repository root:
+
+    python benchmarks/loudness.py --seconds 240
+
+Written by Clysop.
+"""
+
+import os
+import re
+import sys
+import time
+import argparse
+import subprocess
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'src'))
+
+import numpy as np  # noqa: E402
+
+import loudness  # noqa: E402
+from audio import FFMPEG_PATH, BLOCK_SIZE  # noqa: E402
+
+SAMPLE_RATE = 44100
+# Seconds of quiet audio at the start, which R128 gating leaves out.
+INTRO = 20
+
+
+def make_audio(seconds, sample_rate):
+    """Returns random stereo samples as int16, with a quiet intro."""
+    rng = np.random.default_rng(0)
+    frames = int(sample_rate * seconds)
+    samples = rng.normal(0, 3000, (frames, 2))
+    samples[:int(sample_rate * INTRO)] *= 0.01
+    # Make left and right differ, so channels are measured separately.
+    samples[:, 1] *= 0.5
+    return samples.astype(np.int16)
+
+
+def measure(samples, sample_rate, block_frames):
+    """Returns (loudness, seconds) of measuring 'samples' in blocks."""
+    start = time.perf_counter()
+    meter = loudness.Meter(sample_rate)
+    for i in range(0, len(samples), block_frames):
+        meter.add(samples[i:i + block_frames])
+    return meter.integrated(), time.perf_counter() - start
+
+
+def measure_ffmpeg(samples, sample_rate):
+    """Returns (loudness, seconds) of FFmpeg measuring 'samples'."""
+    command = [FFMPEG_PATH, '-hide_banner', '-nostats', '-f', 's16le',
+               '-ac', '2', '-ar', str(sample_rate), '-i', 'pipe:0',
+               '-af', 'ebur128=framelog=verbose', '-f', 'null', '-']
+
+    start = time.perf_counter()
+    out = subprocess.run(command, input=samples.tobytes(),
+                         stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+    seconds = time.perf_counter() - start
+
+    matches = re.findall(r'I:\s+(-?\d+(?:\.\d+)?) LUFS',
+                         out.stderr.decode(errors='replace'))
+    return float(matches[-1]), seconds
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--seconds', type=float, default=240)
+    parser.add_argument('--sample-rate', type=int, default=SAMPLE_RATE)
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+
+    samples = make_audio(args.seconds, args.sample_rate)
+    # Same size of blocks as when streaming stereo audio.
+    block_frames = BLOCK_SIZE // samples.itemsize // 2
+
+    runs = [measure(samples, args.sample_rate, block_frames)
+            for i in range(args.repeat)]
+    value = runs[0][0]
+    seconds = min(r[1] for r in runs)
+    print("{:<8} {:>8.3f} s {:>7.0f}x real time {:>9.2f} LUFS".format(
+        'numpy', seconds, args.seconds / seconds, value))
+
+    try:
+        ffmpeg_value, ffmpeg_seconds = measure_ffmpeg(samples,
+                                                      args.sample_rate)
+    except (OSError, IndexError):
+        print("\nFFmpeg couldn't measure the audio, not compared.")
+        return
+
+    print("{:<8} {:>8.3f} s {:>7.0f}x real time {:>9.2f} LUFS".format(
+        'ffmpeg', ffmpeg_seconds, args.seconds / ffmpeg_seconds,
+        ffmpeg_value))
+    print("\nDifference: {:.2f} LU, FFmpeg rounds to 0.1 LU".format(
+        abs(value - ffmpeg_value)))
+
+
+if __name__ == '__main__':
+    main()
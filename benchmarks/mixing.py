@@ -0,0 +1,98 @@
+"""Benchmarks mixing and volume analysis of the NumPy and audioop engines.
+
+Mixes synthetic raw audio, so no audiofiles or FFmpeg are needed.
+Run from the repository root:
+
+    python benchmarks/mixing.py --stems 10 --seconds 240
+
+Written by Clysop.
+"""
+
+import os
+import sys
+import time
+import argparse
+import tempfile
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'src'))
+
+import numpy as np  # noqa: E402
+
+import song  # noqa: E402
+import mixer  # noqa: E402
+from song import Song  # noqa: E402
+from audio import Audio  # noqa: E402
+
+SAMPLE_RATE = 44100
+
+
+def make_song(path, stems, seconds, mono):
+    """Returns a Song with random raw audio loaded into its Audio objects."""
+    rng = np.random.default_rng(0)
+    s = Song(path)
+
+    for i in range(stems):
+        channels = 1 if i < mono else 2
+        # Vary lengths so padding is exercised.
+        frames = int(SAMPLE_RATE * seconds * (1 - i / (stems * 4)))
+        samples = rng.normal(0, 2000, frames * channels).astype(
+            mixer.SAMPLE_TYPE)
+
+        a = Audio('stem_{}.ogg'.format(i))
+        a.info = {'channels': channels}
+        a.data = samples.tobytes()
+        s.files.append(a)
+
+    return s
+
+
+def measure(s, engine):
+    """Returns (volume, seconds, peak bytes) of analyzing 's' with 'engine'."""
+    song.mixer = engine
+
+    tracemalloc.start()
+    start = time.perf_counter()
+    volume = s.get_volume()
+    seconds = time.perf_counter() - start
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+
+    song.mixer = mixer
+    return volume, seconds, peak
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--stems', type=int, default=10)
+    parser.add_argument('--mono', type=int, default=2,
+                        help='number of stems that are mono')
+    parser.add_argument('--seconds', type=float, default=240)
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as path:
+        open(os.path.join(path, 'notes.chart'), 'w').close()
+        s = make_song(path, args.stems, args.seconds, args.mono)
+
+        print("{} stems ({} mono), {:.0f} s, {:.1f} MB of raw audio.\n".format(
+            args.stems, args.mono, args.seconds,
+            sum(len(a.data) for a in s.files) / 2 ** 20))
+
+        results = {}
+        for name, engine in (('audioop', None), ('numpy', mixer)):
+            runs = [measure(s, engine) for i in range(args.repeat)]
+            volume = runs[0][0]
+            seconds = min(r[1] for r in runs)
+            peak = max(r[2] for r in runs)
+            results[name] = seconds
+
+            print("{:<8} {:>8.3f} s {:>8.1f} MB peak {:>9.3f} dBFS".format(
+                name, seconds, peak / 2 ** 20, volume))
+
+        print("\nSpeedup: {:.1f}x".format(
+            results['audioop'] / results['numpy']))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,260 @@
+"""Benchmarks Normalizer on a synthetic library and stores results as JSON.
+
+Generates a library with library.py, then runs the Normalizer on it twice:
+once from scratch, and once more where every song is cached. Reports
+songs per second, time of each step, taken from the report Normalizer
+writes, and peak memory. The volume measured for each song is stored too,
+so comparing to earlier results shows how far settings that trade
+accuracy for speed are off. Run from the repository root:
+
+    python benchmarks/run.py --songs 50 --output results.json
+    python benchmarks/run.py --songs 50 --set analysis=stream \\
+        --compare results.json
+    python benchmarks/run.py --songs 50 \\
+        --set "analysis sample rate=11025" --compare results.json
+
+Written by Clysop.
+"""
+
+import os
+import re
+import sys
+import json
+import time
+import shutil
+import argparse
+import platform
+import tempfile
+import subprocess
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'src'))
+
+import library  # noqa: E402
+import discovery  # noqa: E402
+
+SRC_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..',
+                        'src')
+NORMALIZER_PATH = os.path.join(SRC_PATH, 'normalizer.py')
+
+# Runs a command and prints the peak RSS in KB of it and its children.
+# The biggest process is measured, not the sum of all of them.
+RSS_WRAPPER = """
+import sys, resource, subprocess
+code = subprocess.run(sys.argv[1:], input=b'\\n').returncode
+print('PEAK_RSS', resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss)
+sys.exit(code)
+"""
+
+# Finds the counts in the summary printed by Normalizer.
+SUMMARY = re.compile(r'^\s+(Found|Exported|Copied|Cached|Errors):\s+(\d+)',
+                     re.MULTILINE)
+PEAK_RSS = re.compile(r'^PEAK_RSS (\d+)', re.MULTILINE)
+
+
+def write_config(path, settings):
+    """Writes a normalizer_config.ini with 'settings' to 'path'."""
+    with open(os.path.join(path, 'normalizer_config.ini'), 'w') as f:
+        f.write('[DEFAULT]\n')
+        for key, value in settings.items():
+            f.write('{} = {}\n'.format(key, value))
+
+
+def run_normalizer(path):
+    """Runs Normalizer in 'path' and measures it.
+
+    Returns:
+        dict: seconds, peak RSS in MB, counts from the summary, summed
+            seconds of each step of processing, and the volume of each song
+            in 'volumes'.
+    """
+    try:
+        import resource  # noqa: F401
+        command = [sys.executable, '-c', RSS_WRAPPER]
+    except ImportError:
+        # Not available on Windows, peak memory isn't measured.
+        command = []
+    command += [sys.executable, NORMALIZER_PATH]
+
+    start = time.perf_counter()
+    out = subprocess.run(command, cwd=path, input=b'\n',
+                         stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+    seconds = time.perf_counter() - start
+
+    text = out.stdout.decode(errors='replace')
+    if out.returncode != 0 or 'CRASH' in text:
+        print(text)
+        raise RuntimeError("Normalizer failed")
+
+    result = {'seconds': round(seconds, 3)}
+    for name, count in SUMMARY.findall(text):
+        result[name.lower()] = int(count)
+
+    rss = PEAK_RSS.search(text)
+    if rss is not None:
+        # KB on Linux, bytes on macOS.
+        scale = 2 ** 20 if sys.platform == 'darwin' else 2 ** 10
+        result['peak_rss_mb'] = round(int(rss.group(1)) / scale, 1)
+
+    # Time of each step of processing, from the report of the run.
+    summary_path = os.path.join(path, 'normalizer_report_summary.json')
+    if os.path.isfile(summary_path):
+        with open(summary_path) as f:
+            stages = json.load(f)['stages']
+        for stage, values in stages.items():
+            result[stage + '_seconds'] = values['seconds']
+
+    result['volumes'] = {}
+    report_path = os.path.join(path, 'normalizer_report.jsonl')
+    if os.path.isfile(report_path):
+        with open(report_path) as f:
+            for line in f:
+                song = json.loads(line)
+                if song['volume'] is not None:
+                    result['volumes'][song['path']] = song['volume']
+
+    processed = result.get('found', 0) - result.get('cached', 0)
+    result['songs_per_s'] = round(
+        (processed or result.get('found', 0)) / seconds, 3)
+    return result
+
+
+def benchmark(path, settings):
+    """Runs all steps of the benchmark on the library in 'path'/Songs.
+
+    Returns:
+        dict: measurements of each step.
+    """
+    # Start from scratch.
+    for name in ('Normalized', 'normalizer_cache.json',
+                 'normalizer_cache.json.journal', 'normalizer_report.jsonl',
+                 'normalizer_report_summary.json'):
+        target = os.path.join(path, name)
+        if os.path.isdir(target):
+            shutil.rmtree(target)
+        elif os.path.isfile(target):
+            os.remove(target)
+    write_config(path, settings)
+
+    start = time.perf_counter()
+    songs = sum(1 for s in discovery.find_songs(os.path.join(path, 'Songs')))
+    discover = time.perf_counter() - start
+    print("Found {} songs in {:.3f} s".format(songs, discover))
+
+    print("Processing...")
+    cold = run_normalizer(path)
+    print("  {:.1f} s, {} songs/s".format(cold['seconds'],
+                                          cold['songs_per_s']))
+
+    print("Processing again, cached...")
+    cached = run_normalizer(path)
+    print("  {:.1f} s".format(cached['seconds']))
+
+    volumes = cold.pop('volumes')
+    cached.pop('volumes')
+
+    return {
+        'discover': {'seconds': round(discover, 3), 'songs': songs},
+        'process': cold,
+        'cached': cached,
+    }, volumes
+
+
+def compare(old, new):
+    """Prints the change of every measurement from 'old' to 'new' results."""
+    print("\nCompared to {}:".format(old.get('time', 'old results')))
+    for step, values in new['steps'].items():
+        for key, value in values.items():
+            before = old['steps'].get(step, {}).get(key)
+            if not isinstance(value, (int, float)) or not before:
+                continue
+            print("  {:<22} {:>10} -> {:>10} {:>+8.1f}%".format(
+                step + ' ' + key, before, value,
+                (value - before) / before * 100))
+
+    # Difference of volumes of songs measured by both.
+    old_volumes = old.get('volumes', {})
+    errors = [abs(volume - old_volumes[path])
+              for path, volume in new.get('volumes', {}).items()
+              if path in old_volumes]
+    if len(errors) > 0:
+        print("  Volume difference of {} songs: mean {:.3f} dB, max {:.3f} "
+              "dB".format(len(errors), sum(errors) / len(errors),
+                          max(errors)))
+
+
+def _commit():
+    """Returns the current git commit of the repository, if any."""
+    try:
+        out = subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=SRC_PATH,
+                             stdout=subprocess.PIPE,
+                             stderr=subprocess.DEVNULL)
+    except OSError:
+        return None
+    return out.stdout.decode().strip() or None
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--dir', help='folder to keep the library in, it '
+                        'is only generated if there is no Songs folder in it. '
+                        'A temporary folder is used by default')
+    parser.add_argument('--songs', type=int, default=20)
+    parser.add_argument('--stems', default='1-6')
+    parser.add_argument('--seconds', default='30-240')
+    parser.add_argument('--mono', type=float, default=0.25)
+    parser.add_argument('--formats', default='ogg')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--set', action='append', default=[],
+                        metavar='KEY=VALUE',
+                        help='setting for normalizer_config.ini, like '
+                        '"analysis=stream". Can be given several times')
+    parser.add_argument('--output', help='file to write results to')
+    parser.add_argument('--compare', help='earlier results to compare to')
+    args = parser.parse_args()
+
+    settings = dict(s.split('=', 1) for s in args.set)
+    settings = {k.strip(): v.strip() for k, v in settings.items()}
+
+    with tempfile.TemporaryDirectory() as temp:
+        path = args.dir or temp
+        songs_path = os.path.join(path, 'Songs')
+
+        params = {
+            'songs': args.songs,
+            'stems': list(library.parse_range(args.stems)),
+            'seconds': list(library.parse_range(args.seconds, float)),
+            'mono': args.mono,
+            'formats': args.formats.split(','),
+            'seed': args.seed,
+        }
+        if not os.path.isdir(songs_path):
+            print("Generating library...")
+            library.generate(songs_path, args.songs, params['stems'],
+                             params['seconds'], args.mono,
+                             params['formats'], args.seed)
+
+        steps, volumes = benchmark(path, settings)
+        results = {
+            'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'commit': _commit(),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'cpus': os.cpu_count(),
+            'library': params,
+            'settings': settings,
+            'steps': steps,
+            'volumes': volumes,
+        }
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+        print("\nResults written to", args.output)
+
+    if args.compare:
+        with open(args.compare) as f:
+            compare(json.load(f), results)
+
+
+if __name__ == '__main__':
+    main()
@@ -6,25 +6,59 @@ Written by Clysop.
 import os
 import sys
 import json
+import mmap
+import shutil
+import tempfile
 import subprocess
+from collections import OrderedDict
 
 import ffmpy
 
+import headers
+
 # Bit width raw audio should be stored as when loaded.
 IMPORT_WIDTH = 16
+# Max number of bytes read from FFmpeg at a time when streaming audio.
+BLOCK_SIZE = 2 ** 16
 
 path = sys.path[0].rpartition('\\')[0]
 FFMPEG_PATH = os.path.join(path, 'FFmpeg/ffmpeg.exe')
 FFPROBE_PATH = os.path.join(path, 'FFmpeg/ffprobe.exe')
 
+# Use FFmpeg from PATH if it isn't next to the program, like on Linux.
+if not os.path.isfile(FFMPEG_PATH):
+    FFMPEG_PATH = shutil.which('ffmpeg') or FFMPEG_PATH
+if not os.path.isfile(FFPROBE_PATH):
+    FFPROBE_PATH = shutil.which('ffprobe') or FFPROBE_PATH
+
+
+def decode_options(sample_rate=None):
+    """Returns FFmpeg output options for decoding to raw audio.
+
+    Channels are always kept, as downmixing changes the power of audio
+    whose channels differ.
+
+    Args:
+        sample_rate (int):  sample rate to resample to, native if None.
+    """
+    options = '-f s{}le'.format(IMPORT_WIDTH)
+    if sample_rate:
+        options += ' -ar {}'.format(sample_rate)
+    return options
+
 
 class Audio():
     """Class for loading and exporting audio using FFmpeg.
 
+    Audio can be probed and loaded by a decoder from the decoders module
+    instead, FFmpeg is used if it fails.
+
     Attributes:
-        filename (str): name of audiofile, used when filepath is needed.
-        data (bytes):   raw audio once loaded, stored as little endian.
-        info (dict):    dict of stream info of probed audiofile.
+        filename (str):     name of audiofile, used when filepath is needed.
+        data (bytes-like):  raw audio once loaded, stored as little endian.
+        info (dict):        dict of stream info of probed audiofile.
+        spill_file (str):   path of file raw audio was spilled to, see
+                            spill. None if it's held in memory.
     """
 
     def __init__(self, filename):
@@ -33,16 +67,32 @@ class Audio():
         self.filename = filename
         self.data = None
         self.info = {}
+        self.spill_file = None
+
+    def probe(self, path, decoder=None):
+        """Reads stream info from self.filename in 'path'.
 
-    def probe(self, path):
-        """Reads stream info from self.filename in 'path' using FFprobe.
+        Reads the file's headers directly if possible, 'decoder' and then
+        FFprobe are only used for files that the headers module can't
+        parse.
 
         Args:
-            path (str): directory that self.filename should be searched for
+            path (str):         directory that self.filename should be
+                                searched for
+            decoder (object):   decoder to try before FFprobe, see the
+                                decoders module.
 
         Returns:
             bool: True if successful, False otherwise.
         """
+        filepath = os.path.join(path, self.filename)
+        info = headers.read_info(filepath)
+        if info is None and decoder is not None:
+            info = decoder.probe(filepath)
+        if info is not None:
+            self.info = info
+            return True
+
         probe = ffmpy.FFprobe(
             executable=FFPROBE_PATH,
             global_options='-show_streams -of json',
@@ -60,19 +110,31 @@ class Audio():
         self.info = json.loads(out)['streams'][0]
         return True
 
-    def load(self, path, debug=False):
-        """Loads audio from self.filename in 'path' using FFmpeg.
+    def load(self, path, debug=False, sample_rate=None, decoder=None):
+        """Loads audio from self.filename in 'path' using FFmpeg or 'decoder'.
 
         Loads raw audio into self.data. Uses info in self.info,
-        so probe should be run before this.
+        so probe should be run before this. Audio loaded at another
+        'sample_rate' can only be analyzed, not exported.
 
         Args:
-            path (str):     directory self.filename should be searched for.
-            debug (bool):   whether FFmpeg should output info when loading.
+            path (str):         directory self.filename should be searched for.
+            debug (bool):       whether FFmpeg should output info when loading.
+            sample_rate (int):  sample rate to load at, native if None.
+            decoder (object):   decoder to try before FFmpeg, see the
+                                decoders module. Only used if audio isn't
+                                resampled.
 
         Return:
             bool: True if successful, False otherwise.
         """
+        native = str(sample_rate) == str(self.info.get('sample_rate'))
+        if decoder is not None and (sample_rate is None or native):
+            self.data = decoder.load(os.path.join(path, self.filename),
+                                     IMPORT_WIDTH)
+            if self.data is not None:
+                return True
+
         if debug:
             output = None
         else:
@@ -82,7 +144,7 @@ class Audio():
             executable=FFMPEG_PATH,
             global_options='-y -loglevel error -stats',
             inputs={os.path.join(path, self.filename): ''},
-            outputs={'pipe:1': '-f s{}le'.format(IMPORT_WIDTH)}
+            outputs={'pipe:1': decode_options(sample_rate)}
         )
         try:
             self.data, err = ff.run(stdout=subprocess.PIPE, stderr=output)
@@ -91,16 +153,174 @@ class Audio():
 
         return True
 
-    def export(self, path, gain=0, debug=False):
+    def spill(self, path, folder, debug=False, sample_rate=None):
+        """Decodes self.filename in 'path' to a temporary file in 'folder'.
+
+        Like load, but FFmpeg writes raw audio to a file, and self.data is
+        a read-only memory map of it. Audio is read from disk as it is
+        used, and the OS can drop it from memory again, so songs bigger
+        than memory can be loaded. Exports read the file directly. Call
+        unload to remove the file.
+
+        Args:
+            path (str):         directory self.filename should be searched for.
+            folder (str):       directory to write the temporary file in.
+            debug (bool):       whether FFmpeg should output info when loading.
+            sample_rate (int):  sample rate to load at, native if None.
+
+        Returns:
+            bool: True if successful, False otherwise.
+        """
+        if debug:
+            output = None
+        else:
+            output = subprocess.PIPE
+
+        os.makedirs(folder, exist_ok=True)
+        fd, self.spill_file = tempfile.mkstemp('.raw', dir=folder)
+        os.close(fd)
+
+        ff = ffmpy.FFmpeg(
+            executable=FFMPEG_PATH,
+            global_options='-y -loglevel error -stats',
+            inputs={os.path.join(path, self.filename): ''},
+            outputs={self.spill_file: decode_options(sample_rate)}
+        )
+        try:
+            ff.run(stdout=subprocess.PIPE, stderr=output)
+        except ffmpy.FFRuntimeError:
+            self.unload()
+            return False
+
+        with open(self.spill_file, 'rb') as f:
+            # Empty files can't be mapped.
+            if os.fstat(f.fileno()).st_size == 0:
+                self.data = b''
+            else:
+                self.data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        return True
+
+    def unload(self):
+        """Frees loaded audio, and removes the file it was spilled to."""
+        if isinstance(self.data, mmap.mmap):
+            try:
+                self.data.close()
+            except BufferError:
+                # Still viewed by an array, it's closed once that is freed.
+                pass
+        self.data = None
+
+        if self.spill_file is not None:
+            try:
+                os.remove(self.spill_file)
+            except OSError:
+                # Still mapped on Windows, see normalizer.SPILL_FOLDER.
+                pass
+            self.spill_file = None
+
+    def load_window(self, path, start, length, debug=False,
+                    sample_rate=None):
+        """Decodes 'length' seconds from 'start' of self.filename in 'path'.
+
+        FFmpeg seeks to 'start' before decoding, so only the window is
+        decoded. Uses info in self.info, so probe should be run before this.
+
+        Args:
+            path (str):         directory self.filename should be searched for.
+            start (float):      second the window starts at.
+            length (float):     length of window in seconds.
+            debug (bool):       whether FFmpeg should output info when loading.
+            sample_rate (int):  sample rate to decode at, native if None.
+
+        Returns:
+            bytes: raw audio of the window, stored as little endian. None
+                if FFmpeg failed.
+        """
+        if debug:
+            output = None
+        else:
+            output = subprocess.PIPE
+
+        ff = ffmpy.FFmpeg(
+            executable=FFMPEG_PATH,
+            global_options='-y -loglevel error',
+            inputs={os.path.join(path, self.filename):
+                    '-ss {:.3f}'.format(start)},
+            outputs={'pipe:1': '-t {:.3f} {}'.format(
+                length, decode_options(sample_rate))}
+        )
+        try:
+            data, err = ff.run(stdout=subprocess.PIPE, stderr=output)
+        except ffmpy.FFRuntimeError:
+            return None
+
+        return data
+
+    def stream(self, path, block_size=BLOCK_SIZE, debug=False,
+               sample_rate=None):
+        """Streams audio from self.filename in 'path' using FFmpeg.
+
+        Reads raw audio from FFmpeg in blocks instead of loading all of it,
+        so only one block is held in memory at a time. Uses info in
+        self.info, so probe should be run before this.
+
+        Args:
+            path (str):         directory self.filename should be searched for.
+            block_size (int):   max number of bytes in each block.
+            debug (bool):       whether FFmpeg should output info when loading.
+            sample_rate (int):  sample rate to decode at, native if None.
+
+        Yields:
+            bytes: block of raw audio, stored as little endian.
+
+        Raises:
+            ffmpy.FFRuntimeError: if FFmpeg fails.
+        """
+        if debug:
+            output = None
+        else:
+            # Stats are written while decoding, an unread pipe would fill up.
+            output = subprocess.DEVNULL
+
+        # ffmpy only runs commands to completion, so start FFmpeg directly.
+        command = [FFMPEG_PATH, '-y', '-loglevel', 'error', '-stats',
+                   '-i', os.path.join(path, self.filename)]
+        command += decode_options(sample_rate).split() + ['pipe:1']
+        process = subprocess.Popen(command, stdout=subprocess.PIPE,
+                                   stderr=output)
+        try:
+            while True:
+                block = process.stdout.read(block_size)
+                if not block:
+                    break
+                yield block
+
+            if process.wait() != 0:
+                raise ffmpy.FFRuntimeError(
+                    subprocess.list2cmdline(command), process.returncode,
+                    None, None)
+        finally:
+            # Stop FFmpeg if the stream wasn't read to the end.
+            if process.poll() is None:
+                process.kill()
+            process.stdout.close()
+            process.wait()
+
+    def export(self, path, gain=0, debug=False, source=None):
         """Exports audio to self.filename in 'path' using FFmpeg.
 
         Exports audio stored in self.data, so audio should be loaded
-        before exporting.
+        before exporting. Spilled audio is read from its file instead of
+        through a pipe. If 'source' is given, the audio is decoded again
+        from self.filename in 'source' instead, so it doesn't have to be
+        kept in memory.
 
         Args:
             path (str):     directory self.filename should be placed in.
             gain (float):   gain to be applied when exporting, in decibel.
             debug (bool):   whether FFmpeg should output info when exporting.
+            source (str):   directory to read self.filename from, if any.
 
         Returns:
             bool: True if successful, False otherwise.
@@ -110,22 +330,19 @@ class Audio():
         else:
             output = subprocess.PIPE
 
-        ch = self.info.get('channels', 2)
-        sr = self.info.get('sample_rate', '44.1k')
-        br = self.info.get('bit_rate', '192k')
+        filepath, options, input_data = self._export_input(source)
 
         ff = ffmpy.FFmpeg(
             executable=FFMPEG_PATH,
             global_options='-y -loglevel error -stats',
-            inputs={'pipe:0': '-f s{}le -ac {} -ar {}'.format(
-                    IMPORT_WIDTH, ch, sr)},
-            outputs={os.path.join(path, self.filename): '-ar {} -b:a {} '
-                     '-filter:a "volume={}dB"'.format(sr, br, gain)}
+            inputs={filepath: options},
+            outputs={os.path.join(path, self.filename):
+                     self._export_options(gain)}
         )
 
         try:
             out, err = ff.run(
-                input_data=self.data,
+                input_data=input_data,
                 stdout=subprocess.PIPE,
                 stderr=output
             )
@@ -133,3 +350,88 @@ class Audio():
             return False
 
         return True
+
+    def _export_input(self, source=None):
+        """Returns the FFmpeg input audio is exported from, see export.
+
+        Returns:
+            tuple: path of input, its options, and raw audio to pipe to
+                FFmpeg, None if it reads the input itself.
+        """
+        if source is not None:
+            return os.path.join(source, self.filename), '', None
+
+        ch = self.info.get('channels', 2)
+        sr = self.info.get('sample_rate', '44.1k')
+        raw = '-f s{}le -ac {} -ar {}'.format(IMPORT_WIDTH, ch, sr)
+        if self.spill_file is not None:
+            return self.spill_file, raw, None
+        else:
+            return 'pipe:0', raw, self.data
+
+    def _export_options(self, gain):
+        """Returns FFmpeg output options exporting audio with 'gain' dB.
+
+        Keeps the sample rate and bit rate in self.info, the codec is
+        chosen by FFmpeg from the extension of self.filename.
+        """
+        sr = self.info.get('sample_rate', '44.1k')
+        br = self.info.get('bit_rate', '192k')
+        return '-ar {} -b:a {} -filter:a "volume={}dB"'.format(sr, br, gain)
+
+
+def export_batch(exports, path, gain=0, debug=False):
+    """Exports several Audio objects to 'path' using one FFmpeg process.
+
+    Like Audio.export, but each audio is an input of the same FFmpeg
+    command, mapped to its own output with its own options, saving
+    starting a process for each. Only one of them can be piped to FFmpeg,
+    the others must be spilled or decoded again from a source.
+
+    Args:
+        exports (list): (Audio, source) tuples, 'source' being the
+                        directory to read the audiofile from, if any, see
+                        Audio.export.
+        path (str):     directory audiofiles should be placed in.
+        gain (float):   gain to be applied when exporting, in decibel.
+        debug (bool):   whether FFmpeg should output info when exporting.
+
+    Returns:
+        bool: True if all audio was exported. FFmpeg stops at the first
+            error, so if False, any of them may not have been exported.
+    """
+    if debug:
+        output = None
+    else:
+        output = subprocess.PIPE
+
+    inputs = OrderedDict()
+    outputs = OrderedDict()
+    input_data = None
+    for i, (a, source) in enumerate(exports):
+        filepath, options, data = a._export_input(source)
+        if data is not None:
+            assert input_data is None, "Only one input can be piped"
+            input_data = data
+
+        inputs[filepath] = options
+        outputs[os.path.join(path, a.filename)] = '-map {}:a:0 {}'.format(
+            i, a._export_options(gain))
+
+    ff = ffmpy.FFmpeg(
+        executable=FFMPEG_PATH,
+        global_options='-y -loglevel error -stats',
+        inputs=inputs,
+        outputs=outputs
+    )
+
+    try:
+        out, err = ff.run(
+            input_data=input_data,
+            stdout=subprocess.PIPE,
+            stderr=output
+        )
+    except ffmpy.FFRuntimeError:
+        return False
+
+    return True
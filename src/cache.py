@@ -0,0 +1,158 @@
+"""Implements the Cache class.
+
+Written by Clysop.
+"""
+
+import os
+import json
+
+# Min number of entries in the journal before it is merged into the snapshot.
+COMPACT_SIZE = 1000
+
+
+class Cache():
+    """Class for storing cache data of songs, which is saved as it changes.
+
+    The cache is saved as a JSON snapshot, plus a journal where every
+    change since the snapshot was written is appended as a line. Saving a
+    song therefore only writes that song. When the journal gets long it is
+    merged into a new snapshot, which replaces the old one in one step, so
+    an interrupted write never leaves a broken cache.
+
+    The snapshot has the same format as cache files from older versions,
+    so these are read as they are.
+
+    Attributes:
+        filename (str):         path of the snapshot file.
+        journal_filename (str): path of the journal file.
+        data (dict):            cache data of each song, by song path.
+    """
+
+    def __init__(self, filename):
+        assert type(filename) is str, "{} is not a string".format(filename)
+
+        self.filename = filename
+        self.journal_filename = filename + '.journal'
+        self.data = {}
+
+        self._journal = None
+        self._journal_size = 0
+
+    def __contains__(self, path):
+        return path in self.data
+
+    def __getitem__(self, path):
+        return self.data[path]
+
+    def __len__(self):
+        return len(self.data)
+
+    def __getstate__(self):
+        # Open files can't be passed to other processes.
+        state = self.__dict__.copy()
+        state['_journal'] = None
+        return state
+
+    def get(self, path, default=None):
+        """Returns cache data of 'path', 'default' if it isn't cached."""
+        return self.data.get(path, default)
+
+    def load(self):
+        """Loads the snapshot and replays the journal on top of it.
+
+        Creates the snapshot if there is none.
+
+        Raises:
+            ValueError: if the snapshot can't be read.
+        """
+        torn = self.read()
+
+        # Rewrite the snapshot if it is missing, or the journal is broken,
+        # so new changes aren't appended to a broken line.
+        if torn or not os.path.isfile(self.filename):
+            self.compact()
+        else:
+            self._journal = open(self.journal_filename, 'a')
+
+    def read(self):
+        """Reads the snapshot and journal without writing to either.
+
+        For reading a cache another process may be writing, like the
+        main cache while running a shard. Nothing is written unless
+        changes are committed.
+
+        Returns:
+            bool: True if the last change in the journal was cut off.
+
+        Raises:
+            ValueError: if the snapshot can't be read.
+        """
+        if os.path.isfile(self.filename):
+            with open(self.filename) as cache_file:
+                self.data = json.load(cache_file)
+
+        torn = False
+        self._journal_size = 0
+        if os.path.isfile(self.journal_filename):
+            with open(self.journal_filename) as journal:
+                for line in journal:
+                    try:
+                        assert line.endswith('\n')
+                        path, data = json.loads(line)
+                    except (AssertionError, ValueError):
+                        # Last change was interrupted while being written.
+                        torn = True
+                        break
+
+                    self.data[path] = data
+                    self._journal_size += 1
+
+        return torn
+
+    def commit(self, path, data):
+        """Sets cache data of 'path' and saves it.
+
+        Args:
+            path (str):     path of song.
+            data (dict):    cache data of song.
+        """
+        self.data[path] = data
+
+        if self._journal is None:
+            self._journal = open(self.journal_filename, 'a')
+
+        self._journal.write(json.dumps([path, data]) + '\n')
+        self._journal.flush()
+        self._journal_size += 1
+
+        if self._journal_size >= max(COMPACT_SIZE, len(self.data)):
+            self.compact()
+
+    def compact(self):
+        """Writes all cache data to a new snapshot and clears the journal."""
+        temp_filename = self.filename + '.tmp'
+        with open(temp_filename, 'w') as cache_file:
+            json.dump(self.data, cache_file)
+            cache_file.flush()
+            os.fsync(cache_file.fileno())
+
+        # Replacing is atomic, so the snapshot is either old or new.
+        os.replace(temp_filename, self.filename)
+
+        # Replaying the journal on the new snapshot changes nothing, so
+        # being interrupted before it is cleared is harmless.
+        if self._journal is not None:
+            self._journal.close()
+        self._journal = open(self.journal_filename, 'w')
+        self._journal_size = 0
+
+    def close(self):
+        """Merges the journal into the snapshot and closes it."""
+        if self._journal is None:
+            return
+
+        if self._journal_size > 0:
+            self.compact()
+
+        self._journal.close()
+        self._journal = None
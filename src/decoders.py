@@ -0,0 +1,108 @@
+"""Decodes audiofiles in this process, without starting FFmpeg.
+
+Decoders have a probe and a load method, like the Audio class, and
+return None when they can't read a file, so FFmpeg can be used instead.
+
+Written by Clysop.
+"""
+
+import os
+
+try:
+    import soundfile
+except (ImportError, OSError):
+    # Not installed, or libsndfile couldn't be loaded. FFmpeg is used.
+    soundfile = None
+
+# Ways of decoding audiofiles, see Audio.load.
+#   soundfile:  decode in this process using libsndfile, which saves
+#               starting an FFmpeg process for every audiofile. Needs the
+#               soundfile package, and libsndfile 1.1 or newer for MP3.
+#   ffmpeg:     decode each audiofile in its own FFmpeg process.
+DECODERS = ('soundfile', 'ffmpeg')
+
+# Codec names FFprobe uses, by libsndfile subtype.
+CODEC_NAMES = {
+    'VORBIS': 'vorbis',
+    'OPUS': 'opus',
+    'MPEG_LAYER_III': 'mp3',
+    'MPEG_LAYER_II': 'mp2',
+    'MPEG_LAYER_I': 'mp1',
+}
+
+
+def get_decoder(name):
+    """Returns the decoder called 'name', see DECODERS.
+
+    Returns:
+        object: decoder with probe and load methods. None if 'name' is
+            'ffmpeg', or the decoder isn't available, so FFmpeg should
+            be used.
+    """
+    assert name in DECODERS, "{} is not a decoder".format(name)
+
+    if name == 'soundfile' and soundfile is not None:
+        return SoundfileDecoder()
+
+    return None
+
+
+class SoundfileDecoder():
+    """Class for decoding audiofiles using libsndfile through soundfile.
+
+    Decodes whole files straight into a NumPy array, without copying
+    audio through a pipe. soundfile releases the GIL while decoding, so
+    several files can be decoded at a time using threads.
+    """
+
+    name = 'soundfile'
+
+    def probe(self, filepath):
+        """Reads stream info of 'filepath'.
+
+        Returns:
+            dict: stream info, using the keys and types FFprobe does. None
+                if the file can't be read.
+        """
+        try:
+            info = soundfile.info(filepath)
+        except (RuntimeError, OSError):
+            return None
+
+        probed = {
+            'codec_name': CODEC_NAMES.get(info.subtype, info.subtype.lower()),
+            'channels': info.channels,
+            'sample_rate': str(info.samplerate),
+            'duration': str(info.duration),
+        }
+        # Average bit rate, libsndfile doesn't read it from the headers.
+        if info.duration > 0:
+            probed['bit_rate'] = str(int(
+                os.path.getsize(filepath) * 8 / info.duration))
+
+        return probed
+
+    def load(self, filepath, width=16):
+        """Decodes all audio in 'filepath'.
+
+        Args:
+            filepath (str): path of audiofile.
+            width (int):    bit width of samples, 16 or 32.
+
+        Returns:
+            memoryview: raw audio, stored as little endian. None if the
+                file can't be decoded, or no audio was decoded.
+        """
+        try:
+            samples, sample_rate = soundfile.read(
+                filepath, dtype='int{}'.format(width), always_2d=True)
+        except (RuntimeError, OSError):
+            return None
+
+        # Nothing decoded, like from a truncated file, which FFmpeg may
+        # still decode part of. Empty views can't be cast either.
+        if samples.size == 0:
+            return None
+
+        samples = samples.astype('<i{}'.format(width // 8), copy=False)
+        return memoryview(samples).cast('B')
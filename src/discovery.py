@@ -0,0 +1,75 @@
+"""Finds songs in a folder, scanning its subfolders in parallel.
+
+Written by Clysop.
+"""
+
+import os
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+from song import Song, CHART_FILES
+
+# Default max number of folders scanned at the same time.
+THREADS = 8
+
+
+def find_songs(folder, threads=THREADS):
+    """Finds all folders in 'folder' that contain a notes file, i.e. all songs.
+
+    Folders are scanned with os.scandir by a pool of threads, and songs
+    are yielded as soon as they are found, so they can be processed while
+    the rest of the folders are scanned. Each folder is only listed once,
+    and only files in song folders are stat'ed.
+
+    Args:
+        folder (str):   folder to search in.
+        threads (int):  max number of folders scanned at the same time.
+
+    Yields:
+        Song: song found, with the stats of its files in Song.sources.
+    """
+    with ThreadPoolExecutor(threads) as executor:
+        pending = {executor.submit(_scan_folder, folder)}
+        while len(pending) > 0:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                song, subfolders = future.result()
+                for subfolder in subfolders:
+                    pending.add(executor.submit(_scan_folder, subfolder))
+
+                if song is not None:
+                    yield song
+
+
+def _scan_folder(path):
+    """Lists a folder, making a Song of it if it contains a notes file.
+
+    Returns:
+        tuple: Song or None, and list of paths of subfolders.
+    """
+    files = {}
+    subfolders = []
+
+    try:
+        with os.scandir(path) as entries:
+            for entry in entries:
+                # Like os.walk, don't follow links to folders.
+                if entry.is_dir(follow_symlinks=False):
+                    subfolders.append(entry.path)
+                elif entry.is_file():
+                    files[entry.name] = entry
+    except OSError:
+        # Like os.walk, skip folders that can't be read.
+        return None, []
+
+    if not any(chart in files for chart in CHART_FILES):
+        return None, subfolders
+
+    sources = {}
+    for filename, entry in files.items():
+        try:
+            stat = entry.stat()
+        except OSError:
+            continue
+        sources[filename] = [stat.st_size, stat.st_mtime_ns]
+
+    return Song(path, sources), subfolders
@@ -0,0 +1,258 @@
+"""Reads stream info from the headers of Ogg Vorbis and MP3 files.
+
+Fills the same keys as FFprobe does, but only reads a few KB of each
+file instead of starting a process. Files that can't be parsed are left
+to FFprobe.
+
+Written by Clysop.
+"""
+
+import os
+import struct
+
+# Max number of bytes read when looking for headers.
+HEAD_SIZE = 2 ** 14
+# Max number of bytes read from the end of Ogg files to find their length.
+TAIL_SIZE = 2 ** 16
+
+# MP3 bit rates in kbit/s by bit rate index, for MPEG-1 and MPEG-2/2.5.
+MP3_BIT_RATES = {
+    1: (0, 32, 40, 48, 56, 64, 80, 96, 112, 128, 160, 192, 224, 256, 320),
+    2: (0, 8, 16, 24, 32, 40, 48, 56, 64, 80, 96, 112, 128, 144, 160),
+}
+# MP3 sample rates by MPEG version and sample rate index.
+MP3_SAMPLE_RATES = {
+    1: (44100, 48000, 32000),
+    2: (22050, 24000, 16000),
+    2.5: (11025, 12000, 8000),
+}
+# MPEG version by the version bits of an MP3 frame header.
+MP3_VERSIONS = {0: 2.5, 2: 2, 3: 1}
+
+
+def read_info(filepath):
+    """Reads stream info from the headers of an audiofile.
+
+    Args:
+        filepath (str): path of an .ogg or .mp3 file.
+
+    Returns:
+        dict: stream info with the same keys and types as FFprobe uses,
+            None if the file couldn't be parsed.
+    """
+    ext = os.path.splitext(filepath)[1].lower()
+
+    try:
+        with open(filepath, 'rb') as f:
+            if ext == '.ogg':
+                return read_ogg(f)
+            elif ext == '.mp3':
+                return read_mp3(f)
+    except (OSError, struct.error, ValueError, IndexError):
+        pass
+
+    return None
+
+
+def read_ogg(f):
+    """Reads stream info from the identification header of Ogg Vorbis.
+
+    Args:
+        f (file): Ogg file opened in binary mode.
+
+    Returns:
+        dict: stream info, None if the file isn't Ogg Vorbis.
+    """
+    head = f.read(HEAD_SIZE)
+    if head[:4] != b'OggS' or len(head) < 27:
+        return None
+
+    # The first packet starts after the page header and segment table.
+    serial = head[14:18]
+    segments = head[26]
+    packet = head[27 + segments:]
+    if packet[:7] != b'\x01vorbis':
+        return None
+
+    (channels, sample_rate, bit_rate_max, bit_rate_nominal,
+     bit_rate_min) = struct.unpack_from('<xxxxBIiii', packet, 7)
+    if channels == 0 or sample_rate == 0:
+        return None
+
+    info = {
+        'codec_name': 'vorbis',
+        'channels': channels,
+        'sample_rate': str(sample_rate),
+    }
+    if bit_rate_nominal > 0:
+        info['bit_rate'] = str(bit_rate_nominal)
+
+    # The granule position of the last page is the length in samples.
+    f.seek(0, os.SEEK_END)
+    f.seek(max(0, f.tell() - TAIL_SIZE))
+    tail = f.read()
+    page = tail.rfind(b'OggS')
+    while page != -1:
+        if tail[page + 14:page + 18] == serial:
+            granule = struct.unpack_from('<q', tail, page + 6)[0]
+            if granule > 0:
+                info['duration'] = '{:.6f}'.format(granule / sample_rate)
+            break
+        page = tail.rfind(b'OggS', 0, page)
+
+    return info
+
+
+def read_mp3(f):
+    """Reads stream info from the first MP3 frame and its Xing/VBRI header.
+
+    Args:
+        f (file): MP3 file opened in binary mode.
+
+    Returns:
+        dict: stream info, None if no valid MP3 frame was found.
+    """
+    f.seek(0, os.SEEK_END)
+    file_size = f.tell()
+
+    # Skip ID3v2 tags, which can be big when they contain album art.
+    start = 0
+    while True:
+        f.seek(start)
+        tag = f.read(10)
+        if tag[:3] != b'ID3' or len(tag) < 10:
+            break
+        size = 0
+        for byte in tag[6:10]:
+            size = (size << 7) | (byte & 0x7f)
+        # Tags with a footer are 10 bytes longer.
+        start += 10 + size + (10 if tag[5] & 0x10 else 0)
+
+    f.seek(start)
+    head = f.read(HEAD_SIZE)
+
+    i = head.find(b'\xff')
+    while i != -1:
+        header = parse_mp3_header(head, i)
+        if header is None:
+            i = head.find(b'\xff', i + 1)
+            continue
+
+        # Check that the next frame follows, to avoid false sync words.
+        following = i + header['frame_size']
+        if following + 4 <= len(head):
+            next_header = parse_mp3_header(head, following)
+            if next_header is None or \
+                    next_header['version'] != header['version'] or \
+                    next_header['sample_rate'] != header['sample_rate']:
+                i = head.find(b'\xff', i + 1)
+                continue
+
+        return _mp3_info(head, i, header, file_size - start - i)
+
+    return None
+
+
+def parse_mp3_header(data, offset):
+    """Parses the MPEG audio layer III frame header at 'offset' in 'data'.
+
+    Args:
+        data (bytes-like):  data containing the header.
+        offset (int):       position of the header in 'data'.
+
+    Returns:
+        dict: header fields, None if there is no valid header at 'offset'.
+    """
+    if offset + 4 > len(data):
+        return None
+
+    b0, b1, b2, b3 = data[offset:offset + 4]
+    if b0 != 0xff or b1 & 0xe0 != 0xe0:
+        return None
+
+    version = MP3_VERSIONS.get((b1 >> 3) & 0x03)
+    layer = (b1 >> 1) & 0x03
+    bit_rate_index = b2 >> 4
+    sample_rate_index = (b2 >> 2) & 0x03
+    # Only layer III with a known bit rate, free format is not supported.
+    if version is None or layer != 1 or bit_rate_index in (0, 15) \
+            or sample_rate_index == 3:
+        return None
+
+    lsf = version != 1
+    bit_rate = MP3_BIT_RATES[2 if lsf else 1][bit_rate_index] * 1000
+    sample_rate = MP3_SAMPLE_RATES[version][sample_rate_index]
+    padding = (b2 >> 1) & 0x01
+    channels = 1 if b3 >> 6 == 3 else 2
+
+    return {
+        'version': version,
+        'protected': not b1 & 0x01,
+        'bit_rate': bit_rate,
+        'sample_rate': sample_rate,
+        'channels': channels,
+        'samples': 576 if lsf else 1152,
+        'frame_size': (72 if lsf else 144) * bit_rate // sample_rate + padding,
+        'side_info_size': side_info_size(version, channels),
+    }
+
+
+def side_info_size(version, channels):
+    """Returns the size in bytes of the side info of an MP3 frame."""
+    if version == 1:
+        return 17 if channels == 1 else 32
+    else:
+        return 9 if channels == 1 else 17
+
+
+def _mp3_info(head, offset, header, audio_size):
+    """Returns FFprobe style stream info of an MP3 file.
+
+    Uses the Xing/Info or VBRI header in the first frame if there is one,
+    otherwise assumes a constant bit rate.
+
+    Args:
+        head (bytes):       start of the file, containing the first frame.
+        offset (int):       position of the first frame in 'head'.
+        header (dict):      parsed header of the first frame.
+        audio_size (int):   number of bytes from the first frame to the end.
+    """
+    frames = None
+    size = None
+    # Info headers are written by LAME for files with a constant bit rate.
+    constant = True
+
+    xing = offset + 4 + header['side_info_size']
+    vbri = offset + 4 + 32
+    if head[xing:xing + 4] in (b'Xing', b'Info'):
+        constant = head[xing:xing + 4] == b'Info'
+        flags = struct.unpack_from('>I', head, xing + 4)[0]
+        position = xing + 8
+        if flags & 0x01:
+            frames = struct.unpack_from('>I', head, position)[0]
+            position += 4
+        if flags & 0x02:
+            size = struct.unpack_from('>I', head, position)[0]
+    elif head[vbri:vbri + 4] == b'VBRI':
+        constant = False
+        size, frames = struct.unpack_from('>II', head, vbri + 10)
+
+    info = {
+        'codec_name': 'mp3',
+        'channels': header['channels'],
+        'sample_rate': str(header['sample_rate']),
+    }
+
+    if frames:
+        duration = frames * header['samples'] / header['sample_rate']
+    else:
+        duration = audio_size * 8 / header['bit_rate']
+
+    if constant:
+        bit_rate = header['bit_rate']
+    else:
+        bit_rate = (size or audio_size) * 8 / duration
+
+    info['bit_rate'] = str(int(bit_rate))
+    info['duration'] = '{:.6f}'.format(duration)
+    return info
@@ -0,0 +1,110 @@
+"""Copies files by linking them where the filesystem allows it.
+
+Written by Clysop.
+"""
+
+import os
+import shutil
+
+try:
+    import fcntl
+except ImportError:
+    # Not available on Windows, reflinks are only made on Linux.
+    fcntl = None
+
+# Ways of copying files, in the order they are tried.
+#   reflink:    copy on write clone, shares data until either file changes.
+#   hardlink:   both paths point to the same file.
+#   symlink:    the copy is a link to the original path. Only used when
+#               chosen, as the link breaks if the original is renamed.
+#   copy:       plain copy.
+LINK_MODES = ('reflink', 'hardlink', 'symlink', 'copy')
+
+# ioctl request that clones a whole file, from linux/fs.h.
+FICLONE = 0x40049409
+# Max number of bytes copied by one call to os.copy_file_range.
+COPY_RANGE_SIZE = 2 ** 30
+
+
+def link_file(src, dst, mode='copy'):
+    """Copies file 'src' to 'dst' using link mode 'mode'.
+
+    If 'mode' fails, for instance because the filesystem doesn't support
+    it, the modes after it in LINK_MODES are tried in turn, leaving out
+    symlink unless it is 'mode'. An existing 'dst' is replaced. Copies
+    keep the modification time of 'src'.
+
+    Args:
+        src (str):  path of file to copy.
+        dst (str):  path of the copy.
+        mode (str): link mode to try first, see LINK_MODES.
+
+    Returns:
+        str: link mode that was used.
+
+    Raises:
+        OSError: if even a plain copy failed.
+    """
+    assert mode in LINK_MODES, "{} is not a link mode".format(mode)
+
+    # Links can't replace files, and writing to an old hardlink would
+    # change the original.
+    if os.path.lexists(dst):
+        os.remove(dst)
+
+    modes = [m for m in LINK_MODES[LINK_MODES.index(mode):]
+             if m != 'symlink' or m == mode]
+    for mode in modes:
+        if mode == 'copy':
+            shutil.copy2(src, dst)
+            return mode
+
+        try:
+            if mode == 'reflink':
+                reflink(src, dst)
+            elif mode == 'hardlink':
+                os.link(src, dst)
+            elif mode == 'symlink':
+                os.symlink(os.path.abspath(src), dst)
+            return mode
+        except (OSError, NotImplementedError):
+            if os.path.lexists(dst):
+                os.remove(dst)
+
+    # Not reached, plain copies either succeed or raise.
+    return None
+
+
+def reflink(src, dst):
+    """Clones 'src' to 'dst' without copying its data.
+
+    Uses the FICLONE ioctl, which makes a copy on write clone on
+    filesystems like Btrfs and XFS. Falls back to os.copy_file_range,
+    which lets the kernel copy the data, and clone it where it can.
+
+    Raises:
+        OSError: if the filesystem can't do either.
+        NotImplementedError: if neither is available on this system.
+    """
+    if fcntl is None and not hasattr(os, 'copy_file_range'):
+        raise NotImplementedError("Reflinks are not supported")
+
+    with open(src, 'rb') as fsrc, open(dst, 'wb') as fdst:
+        try:
+            if fcntl is None:
+                raise OSError("FICLONE is not supported")
+            fcntl.ioctl(fdst.fileno(), FICLONE, fsrc.fileno())
+        except OSError:
+            if not hasattr(os, 'copy_file_range'):
+                raise
+
+            size = os.fstat(fsrc.fileno()).st_size
+            copied = 0
+            while copied < size:
+                n = os.copy_file_range(fsrc.fileno(), fdst.fileno(),
+                                       min(size - copied, COPY_RANGE_SIZE))
+                if n == 0:
+                    raise OSError("copy_file_range copied nothing")
+                copied += n
+
+    shutil.copystat(src, dst)
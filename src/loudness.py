@@ -0,0 +1,265 @@
+"""Measures loudness of audio as in EBU R128, using NumPy.
+
+Implements integrated loudness of ITU-R BS.1770: audio is K-weighted,
+its power measured in 400 ms blocks overlapping by 75%, and blocks below
+an absolute gate, and then below a gate relative to the loudness of the
+blocks left, are left out. Audio is fed to a Meter in chunks, so songs
+can be measured while they are streamed.
+
+Written by Clysop.
+"""
+
+import math
+import functools
+
+import numpy as np
+
+from audio import IMPORT_WIDTH
+
+# Value of a full scale sample, see IMPORT_WIDTH.
+FULL_SCALE = 2 ** (IMPORT_WIDTH - 1)
+
+# Length of gating blocks, and time between the start of each, in seconds.
+BLOCK_TIME = 0.4
+STEP_TIME = 0.1
+# Blocks quieter than this in LUFS are left out.
+ABSOLUTE_GATE = -70
+# Blocks this many LU quieter than the blocks above ABSOLUTE_GATE are
+# left out.
+RELATIVE_GATE = -10
+# Loudness in LUFS of full scale K-weighted power.
+OFFSET = -0.691
+
+# Biquads are solved this many samples at a time, using a matrix of their
+# impulse response, and the state between these blocks is solved for
+# FILTER_BLOCKS blocks at a time. Longer audio is filtered in chunks of
+# CHUNK_FRAMES frames.
+FILTER_BLOCK = 64
+FILTER_BLOCKS = 256
+CHUNK_FRAMES = FILTER_BLOCK * FILTER_BLOCKS
+
+
+def k_weighting(sample_rate):
+    """Returns the biquads of the K-weighting filter at 'sample_rate'.
+
+    Designs the high shelf and high pass of BS.1770 for any sample rate,
+    giving the coefficients from the standard at 48 kHz.
+
+    Returns:
+        list: (b, a) tuples of coefficients of each biquad.
+    """
+    f0 = 1681.974450955533
+    gain = 3.999843853973347
+    q = 0.7071752369554196
+    k = math.tan(math.pi * f0 / sample_rate)
+    vh = 10 ** (gain / 20)
+    vb = vh ** 0.4996667741545416
+    a0 = 1 + k / q + k * k
+    shelf = ((vh + vb * k / q + k * k) / a0,
+             2 * (k * k - vh) / a0,
+             (vh - vb * k / q + k * k) / a0), \
+        (1.0, 2 * (k * k - 1) / a0, (1 - k / q + k * k) / a0)
+
+    f0 = 38.13547087602444
+    q = 0.5003270373238773
+    k = math.tan(math.pi * f0 / sample_rate)
+    a0 = 1 + k / q + k * k
+    high_pass = (1.0, -2.0, 1.0), \
+        (1.0, 2 * (k * k - 1) / a0, (1 - k / q + k * k) / a0)
+
+    return [shelf, high_pass]
+
+
+@functools.lru_cache(maxsize=8)
+def _solve_matrices(a):
+    """Returns matrices solving the recursive part of biquad 'a' in blocks.
+
+    Args:
+        a (tuple): feedback coefficients of a biquad, a[0] being 1.
+
+    Returns:
+        tuple: matrix of the impulse response applied to a block, matrix of
+            the response of a block to the two outputs before it, and
+            matrices giving the last two outputs of each of FILTER_BLOCKS
+            blocks from those of each block alone, and from the outputs
+            before the first block.
+    """
+    # Response to an impulse, and to each of the two outputs before it.
+    response = np.zeros((FILTER_BLOCK + 2, 3))
+    response[:2, 1:] = [[0, 1], [1, 0]]
+    response[2, 0] = 1
+    for n in range(2, FILTER_BLOCK + 2):
+        response[n] -= a[1] * response[n - 1] + a[2] * response[n - 2]
+    impulse, previous = response[2:, 0], response[2:, 1:]
+
+    i = np.arange(FILTER_BLOCK)
+    lag = i[:, None] - i[None, :]
+    block = np.where(lag >= 0, impulse[np.maximum(lag, 0)], 0.0)
+
+    # Last two outputs of a block, newest first, from the two before it.
+    step = previous[:-3:-1]
+    powers = [np.eye(2)]
+    for n in range(FILTER_BLOCKS):
+        powers.append(step @ powers[-1])
+    powers = np.array(powers)
+
+    i = np.arange(FILTER_BLOCKS)
+    lag = i[:, None] - i[None, :]
+    ends = np.where((lag >= 0)[:, :, None, None],
+                    powers[np.maximum(lag, 0)], 0.0)
+    ends = ends.transpose(0, 2, 1, 3).reshape(2 * FILTER_BLOCKS,
+                                              2 * FILTER_BLOCKS)
+
+    return block, previous, ends, powers[1:].reshape(-1, 2)
+
+
+class Biquad():
+    """Class for filtering audio with a biquad, keeping its state.
+
+    Audio filtered in chunks gives the same result as filtering it all
+    at once. The recursive part is solved exactly in blocks of
+    FILTER_BLOCK samples using matrices, as NumPy can't run it sample by
+    sample fast enough.
+
+    Attributes:
+        b (tuple):  feedforward coefficients.
+        a (tuple):  feedback coefficients, a[0] being 1.
+    """
+
+    def __init__(self, b, a, channels=2):
+        self.b = tuple(b)
+        self.a = tuple(a)
+
+        self._inputs = np.zeros((2, channels))
+        # Last two outputs, newest first.
+        self._outputs = np.zeros((2, channels))
+        self._block, self._previous, self._ends, self._start = \
+            _solve_matrices(self.a)
+
+    def process(self, samples):
+        """Returns 'samples' filtered.
+
+        Args:
+            samples (numpy.ndarray): float samples, 2D with one row per
+                frame, at most CHUNK_FRAMES frames.
+        """
+        frames, channels = samples.shape
+        assert frames <= CHUNK_FRAMES, "Too many frames to filter at once"
+
+        padded = np.concatenate([self._inputs, samples])
+        self._inputs = padded[-2:]
+        filtered = self.b[0] * padded[2:] + self.b[1] * padded[1:-1] + \
+            self.b[2] * padded[:-2]
+
+        # Pad to whole blocks, then solve each block as if it started
+        # from silence, with blocks as columns.
+        blocks = -(-frames // FILTER_BLOCK)
+        filtered.resize((blocks * FILTER_BLOCK, channels), refcheck=False)
+        columns = filtered.reshape(blocks, FILTER_BLOCK, channels) \
+            .transpose(1, 0, 2).reshape(FILTER_BLOCK, blocks * channels)
+        outputs = self._block @ columns
+
+        # Find the outputs before each block, then add their response.
+        ends = outputs[:-3:-1].reshape(2, blocks, channels) \
+            .transpose(1, 0, 2).reshape(2 * blocks, channels)
+        ends = self._ends[:2 * blocks, :2 * blocks] @ ends + \
+            self._start[:2 * blocks] @ self._outputs
+        before = np.concatenate([self._outputs, ends[:-2]]) \
+            .reshape(blocks, 2, channels).transpose(1, 0, 2) \
+            .reshape(2, blocks * channels)
+        outputs += self._previous @ before
+
+        outputs = outputs.reshape(FILTER_BLOCK, blocks, channels) \
+            .transpose(1, 0, 2).reshape(blocks * FILTER_BLOCK, channels)
+        outputs = outputs[:frames]
+
+        self._outputs = np.concatenate([self._outputs[::-1], outputs])[:-3:-1]
+        return outputs
+
+
+class Meter():
+    """Class for measuring integrated loudness of audio fed in chunks.
+
+    Keeps the K-weighted power of every 100 ms of audio, so memory grows
+    by a few bytes per second of audio, not with the audio itself.
+
+    Attributes:
+        sample_rate (int):  sample rate of audio.
+        channels (int):     number of channels of audio.
+    """
+
+    def __init__(self, sample_rate, channels=2):
+        self.sample_rate = sample_rate
+        self.channels = channels
+
+        self._filters = [Biquad(b, a, channels)
+                         for b, a in k_weighting(sample_rate)]
+        self._step = round(sample_rate * STEP_TIME)
+        # Power of samples after the last whole step.
+        self._rest = np.zeros(0)
+        # Power of each whole step.
+        self._steps = []
+
+    def add(self, samples):
+        """Adds audio to the measurement.
+
+        Args:
+            samples (numpy.ndarray): integer samples, 2D with one row per
+                frame, see mixer.to_samples and mixer.mix.
+        """
+        for i in range(0, len(samples), CHUNK_FRAMES):
+            chunk = samples[i:i + CHUNK_FRAMES].astype(np.float64)
+            chunk /= FULL_SCALE
+            for f in self._filters:
+                chunk = f.process(chunk)
+
+            power = np.concatenate([self._rest, np.einsum('ij,ij->i',
+                                                          chunk, chunk)])
+            steps = len(power) // self._step
+            self._steps.append(power[:steps * self._step]
+                               .reshape(steps, self._step).sum(axis=1))
+            self._rest = power[steps * self._step:]
+
+    def block_powers(self):
+        """Returns the mean K-weighted power of each gating block so far."""
+        steps = np.concatenate([np.zeros(1)] + self._steps).cumsum()
+        size = round(BLOCK_TIME / STEP_TIME)
+        return (steps[size:] - steps[:-size]) / (size * self._step)
+
+    def integrated(self):
+        """Returns the integrated loudness of audio so far in LUFS."""
+        return gate(self.block_powers())
+
+
+def gate(powers):
+    """Returns the integrated loudness in LUFS of gating block powers.
+
+    Args:
+        powers (array-like): mean K-weighted power of each block, see
+            Meter.block_powers.
+
+    Returns:
+        float: loudness in LUFS, -inf if every block is gated.
+    """
+    powers = np.asarray(powers)
+    powers = powers[powers > 10 ** ((ABSOLUTE_GATE - OFFSET) / 10)]
+    if len(powers) == 0:
+        return -math.inf
+
+    powers = powers[powers > powers.mean() * 10 ** (RELATIVE_GATE / 10)]
+    return to_lufs(powers.mean())
+
+
+def to_lufs(power):
+    """Converts mean K-weighted power to LUFS."""
+    if power <= 0:
+        return -math.inf
+    else:
+        return OFFSET + 10 * math.log10(power)
+
+
+def integrated(samples, sample_rate):
+    """Returns the integrated loudness of 'samples' in LUFS, see Meter."""
+    meter = Meter(sample_rate, samples.shape[1])
+    meter.add(samples)
+    return meter.integrated()
@@ -0,0 +1,110 @@
+"""Implements mixing and analysis of raw audio using NumPy.
+
+Written by Clysop.
+"""
+
+import math
+
+import numpy as np
+
+from audio import IMPORT_WIDTH
+
+# NumPy type of raw audio as it is loaded, see IMPORT_WIDTH.
+SAMPLE_TYPE = np.dtype('<i{}'.format(IMPORT_WIDTH // 8))
+# Range of values a sample can hold.
+SAMPLE_MIN = -2 ** (IMPORT_WIDTH - 1)
+SAMPLE_MAX = 2 ** (IMPORT_WIDTH - 1) - 1
+
+# Max number of samples converted to float at a time when computing RMS.
+CHUNK_SIZE = 2 ** 20
+# Number of frames mixed at a time by mix_blocks.
+BLOCK_FRAMES = 2 ** 18
+
+
+def to_samples(data, channels=2):
+    """Returns a view of raw audio as an array of samples, without copying.
+
+    Args:
+        data (bytes-like):  raw audio, stored as little endian.
+        channels (int):     number of channels in 'data'.
+
+    Returns:
+        numpy.ndarray: samples, 2D with one row per frame.
+    """
+    frames = len(data) // SAMPLE_TYPE.itemsize // channels
+    samples = np.frombuffer(data, SAMPLE_TYPE, frames * channels)
+    return samples.reshape(frames, channels)
+
+
+def mix(stems):
+    """Mixes raw audio into one stereo array in a single pass.
+
+    Adds every stem into one preallocated array, mono stems are broadcast
+    to both channels. Samples are clipped to the range of IMPORT_WIDTH,
+    like they would be when exported.
+
+    Args:
+        stems (list): (data, channels) tuples, 'data' being raw audio.
+
+    Returns:
+        numpy.ndarray: mixed samples as int32, 2D with one row per frame.
+    """
+    return _mix([to_samples(data, channels) for data, channels in stems])
+
+
+def mix_blocks(stems, block_frames=BLOCK_FRAMES):
+    """Mixes raw audio like mix, 'block_frames' frames at a time.
+
+    Only one block of the mix is held in memory at a time, and stems are
+    read as views, so audio mapped from disk, see Audio.spill, is never
+    copied whole.
+
+    Args:
+        stems (list):       (data, channels) tuples, 'data' being raw audio.
+        block_frames (int): number of frames in each block.
+
+    Yields:
+        numpy.ndarray: block of mixed samples as int32, 2D with one row
+            per frame.
+    """
+    stems = [to_samples(data, channels) for data, channels in stems]
+    frames = max((len(samples) for samples in stems), default=0)
+
+    for start in range(0, frames, block_frames):
+        yield _mix([samples[start:start + block_frames]
+                    for samples in stems])
+
+
+def _mix(stems):
+    """Mixes arrays of samples from to_samples, see mix."""
+    frames = max((len(samples) for samples in stems), default=0)
+
+    mixed = np.zeros((frames, 2), np.int32)
+    for samples in stems:
+        # Mono is broadcast to stereo, other stems are mixed as stereo.
+        mixed[:len(samples)] += samples[:, :2]
+
+    if len(stems) > 1:
+        np.clip(mixed, SAMPLE_MIN, SAMPLE_MAX, out=mixed)
+
+    return mixed
+
+
+def sum_squares(samples):
+    """Returns the sum of the squares of all samples in 'samples'."""
+    samples = samples.reshape(-1)
+
+    total = 0.0
+    for i in range(0, len(samples), CHUNK_SIZE):
+        chunk = samples[i:i + CHUNK_SIZE].astype(np.float64)
+        total += float(np.dot(chunk, chunk))
+
+    return total
+
+
+def rms(samples):
+    """Returns the RMS of all samples in 'samples'."""
+    if samples.size == 0:
+        return 0.0
+
+    return math.sqrt(sum_squares(samples) / samples.size)
@@ -0,0 +1,180 @@
+"""Changes the gain of MP3 files without decoding them.
+
+Every granule of an MP3 frame has a global_gain field, and raising it by
+one changes the volume by 1.5 dB. Rewriting these fields changes the
+volume losslessly, but only in steps of GAIN_STEP.
+
+Written by Clysop.
+"""
+
+import os
+import math
+import mmap
+
+import headers
+
+# Change in dB of one step of global_gain.
+GAIN_STEP = 20 * math.log10(2 ** (1 / 4))
+
+
+def gain_steps(gain):
+    """Returns the number of global_gain steps closest to 'gain' dB."""
+    return round(gain / GAIN_STEP)
+
+
+def apply_gain(src, dst, steps):
+    """Writes MP3 file 'src' to 'dst' with the gain changed by 'steps'.
+
+    Walks every frame in 'src' and changes the global_gain of each of
+    its granules. Tags and anything that isn't a frame are copied as is.
+
+    Args:
+        src (str):      path of MP3 file to read.
+        dst (str):      path of MP3 file to write.
+        steps (int):    number of GAIN_STEP to change the gain by.
+
+    Returns:
+        bool: True if successful, False if 'src' couldn't be parsed or the
+            gain couldn't be changed that much.
+    """
+    try:
+        with open(src, 'rb') as f, \
+                mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data, \
+                open(dst, 'wb') as out:
+            success = _write_frames(data, out, steps)
+    except (OSError, ValueError):
+        success = False
+
+    if not success and os.path.isfile(dst):
+        os.remove(dst)
+
+    return success
+
+
+def _write_frames(data, out, steps):
+    """Writes 'data' to 'out', changing the gain of every frame.
+
+    Returns:
+        bool: True if any frame was written, False if a frame couldn't be
+            changed or none were found.
+    """
+    pos = 0
+    frames = 0
+    first = None
+
+    # Copy ID3v2 tags.
+    while data[pos:pos + 3] == b'ID3' and pos + 10 <= len(data):
+        size = 0
+        for byte in data[pos + 6:pos + 10]:
+            size = (size << 7) | (byte & 0x7f)
+        end = pos + 10 + size + (10 if data[pos + 5] & 0x10 else 0)
+        out.write(data[pos:end])
+        pos = end
+
+    while pos < len(data):
+        header = headers.parse_mp3_header(data, pos)
+        if header is not None and first is not None and \
+                (header['version'], header['sample_rate']) != first:
+            # False sync word, all frames have the same format.
+            header = None
+
+        if header is None or pos + header['frame_size'] > len(data):
+            # Copy anything that isn't a whole frame, like ID3v1 tags.
+            end = data.find(b'\xff', pos + 1)
+            if end == -1:
+                end = len(data)
+            out.write(data[pos:end])
+            pos = end
+            continue
+
+        frame = bytearray(data[pos:pos + header['frame_size']])
+        # Xing, Info and VBRI frames contain no audio, so leave them.
+        if frames > 0 or not _is_info_frame(frame, header):
+            if not _change_gain(frame, header, steps):
+                return False
+
+        out.write(frame)
+        pos += header['frame_size']
+        frames += 1
+        first = (header['version'], header['sample_rate'])
+
+    return frames > 0
+
+
+def _is_info_frame(frame, header):
+    """Returns True if 'frame' holds a Xing, Info or VBRI header."""
+    xing = 4 + header['side_info_size']
+    return frame[xing:xing + 4] in (b'Xing', b'Info') \
+        or frame[36:40] == b'VBRI'
+
+
+def _change_gain(frame, header, steps):
+    """Changes global_gain of every granule in 'frame' by 'steps'.
+
+    Returns:
+        bool: True if successful, False if a gain is out of range.
+    """
+    channels = header['channels']
+    side_info = 6 if header['protected'] else 4
+
+    # Bit offsets of the granule fields, past main_data_begin, private
+    # bits and, for MPEG-1, scfsi. global_gain follows part2_3_length
+    # and big_values.
+    if header['version'] == 1:
+        start = 9 + (5 if channels == 1 else 3) + 4 * channels
+        granules = 2 * channels
+        granule_size = 59
+    else:
+        start = 8 + (1 if channels == 1 else 2)
+        granules = channels
+        granule_size = 63
+
+    for i in range(granules):
+        bit = side_info * 8 + start + i * granule_size
+        gain = _read_bits(frame, bit + 21, 8) + steps
+
+        if gain < 0 and _read_bits(frame, bit, 12) == 0:
+            # Granule without audio data, its gain doesn't matter.
+            gain = 0
+        elif not 0 <= gain <= 255:
+            return False
+
+        _write_bits(frame, bit + 21, 8, gain)
+
+    if header['protected']:
+        crc = _crc16(frame[2:4] + frame[6:6 + header['side_info_size']])
+        frame[4:6] = crc.to_bytes(2, 'big')
+
+    return True
+
+
+def _read_bits(data, bit, length):
+    """Returns 'length' bits starting at bit 'bit' of 'data' as an int."""
+    first = bit // 8
+    last = (bit + length - 1) // 8
+    value = int.from_bytes(data[first:last + 1], 'big')
+    return (value >> ((last + 1) * 8 - bit - length)) & ((1 << length) - 1)
+
+
+def _write_bits(data, bit, length, value):
+    """Writes 'value' into 'length' bits starting at bit 'bit' of 'data'."""
+    first = bit // 8
+    last = (bit + length - 1) // 8
+    shift = (last + 1) * 8 - bit - length
+    mask = ((1 << length) - 1) << shift
+
+    word = int.from_bytes(data[first:last + 1], 'big')
+    word = (word & ~mask) | (value << shift)
+    data[first:last + 1] = word.to_bytes(last - first + 1, 'big')
+
+
+def _crc16(data):
+    """Returns the CRC-16 used to protect MP3 frame headers and side info."""
+    crc = 0xffff
+    for byte in data:
+        crc ^= byte << 8
+        for i in range(8):
+            crc <<= 1
+            if crc & 0x10000:
+                crc ^= 0x18005
+    return crc
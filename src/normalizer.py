@@ -5,67 +5,218 @@ Written be Clysop.
 
 import os
 import sys
-import json
 import time
 import shutil
+import traceback
 import logging
+import argparse
 import datetime
+import itertools
 import configparser
 import multiprocessing
-
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+import watch
+import linking
+import pipeline
+import discovery
+import decoders
+import scheduler
+import sharding
+from cache import Cache
+from report import Report
 from song import Song
 
-# Allows passing exceptions between processes.
-import tblib.pickling_support
-tblib.pickling_support.install()
+try:
+    import loudness
+except ImportError:
+    # NumPy is not installed, R128 loudness can only be measured by FFmpeg.
+    loudness = None
 
 # Name of folder that contains songs.
 INPUT_FOLDER = 'Songs'
 # Name of folder to output to. Will be created if it doesn't exist.
 OUTPUT_FOLDER = 'Normalized'
+# Folder audio of songs too big to load is spilled to, see SPILL_SIZE. In
+# OUTPUT_FOLDER so it's on the drive being written to anyway. Removed
+# before and after processing, also removing files left by a crash.
+SPILL_FOLDER = os.path.join(OUTPUT_FOLDER, '.spill')
 
 # Default settings.
-TARGET_GAIN = -16       # Target volume in dBFS.
+TARGET_GAIN = -16       # Target volume in dBFS, or LUFS, see LOUDNESS.
 HEADROOM = 1            # If song within this dB, copy instead of process.
 DEBUG_LOAD = False      # Print FFmpeg info when loading.
 DEBUG_EXPORT = False    # Print FFmpeg ingo when exporting.
 MULTITHREADING = True   # Process a song on each logical core the CPU has.
+ANALYSIS = 'full'       # How volume is analyzed, see ANALYSIS_MODES.
+EXPORT_SOURCE = False   # Export by decoding original audio again.
+LOSSLESS_MP3 = True     # Change gain of MP3 files without reencoding.
+FINGERPRINTS = False    # Check content of files whose time has changed.
+DISCOVERY_THREADS = 8   # Max number of folders searched for songs at a time.
+SCHEDULING = 'largest first'  # Order songs are processed in.
+MEMORY_BUDGET = 4096    # Max MB of audio held in memory by all processes.
+PIPELINE = False        # Process songs in stages instead of processes.
+ANALYZE_THREADS = 2     # Songs analyzed at a time by the pipeline.
+ENCODE_THREADS = 4      # Songs exported at a time by the pipeline.
+COPY_THREADS = 2        # Songs copied at a time by the pipeline.
+DECODE_THREADS = 1      # Audiofiles of a song loaded at a time.
+LINK_MODE = 'copy'      # How unchanged files are copied, see LINK_MODES.
+SETTLE_TIME = 3         # Seconds a song must be unchanged when watching.
+REPORT = True           # Write how long each step took for every song.
+SAMPLE_WINDOWS = 8      # Windows decoded per song by sampled analysis.
+WINDOW_LENGTH = 3       # Seconds of each window of sampled analysis.
+ANALYSIS_RATE = 0       # Sample rate audio is analyzed at, 0 for native.
+LOUDNESS = 'rms'        # How volume is measured, see LOUDNESS_MODES.
+DECODER = 'soundfile'   # How audiofiles are loaded, see DECODERS.
+TASKS_PER_PROCESS = 50  # Songs a process handles before it's replaced.
+SPILL_SIZE = 1024       # MB of audio a song is spilled to disk above, or 0.
+
+# Settings loaded from the config, passed on to processes when multithreading.
+SETTINGS = (
+    'TARGET_GAIN', 'HEADROOM', 'DEBUG_LOAD', 'DEBUG_EXPORT', 'MULTITHREADING',
+    'ANALYSIS', 'EXPORT_SOURCE', 'LOSSLESS_MP3', 'FINGERPRINTS',
+    'DISCOVERY_THREADS', 'SCHEDULING', 'MEMORY_BUDGET', 'PIPELINE',
+    'ANALYZE_THREADS', 'ENCODE_THREADS', 'COPY_THREADS', 'DECODE_THREADS',
+    'LINK_MODE', 'SETTLE_TIME', 'REPORT', 'SAMPLE_WINDOWS', 'WINDOW_LENGTH',
+    'ANALYSIS_RATE', 'LOUDNESS', 'DECODER', 'TASKS_PER_PROCESS', 'SPILL_SIZE',
+)
+
+# Ways of analyzing volume.
+#   full:   load all audio of a song into memory, then analyze it.
+#   stream: analyze audio in blocks while it is decoded, using little memory.
+#   ffmpeg: mix and analyze all audio of a song in one FFmpeg process.
+#   sampled: estimate volume from a few short windows of a song, and
+#            stream the whole song if the estimate isn't good enough.
+ANALYSIS_MODES = ('full', 'stream', 'ffmpeg', 'sampled')
+
+# Orders songs can be processed in when multithreading.
+#   as found:       as soon as they are found.
+#   largest first:  biggest audio first, once all songs are found.
+SCHEDULING_MODES = ('as found', 'largest first')
+
+# Ways of copying files that aren't exported, tried in this order when
+# the chosen one isn't supported. See the linking module.
+LINK_MODES = linking.LINK_MODES
+
+# Ways of measuring the volume of songs, stored in the cache with it.
+#   rms:    RMS of the mixed song, in dBFS.
+#   r128:   integrated loudness of EBU R128, in LUFS. Leaves out silence
+#           and quiet parts, like intros and outros, so it matches how
+#           loud a song sounds better.
+LOUDNESS_MODES = ('rms', 'r128')
+# Unit of volume of each way of measuring it.
+UNITS = {'rms': 'dBFS', 'r128': 'LUFS'}
+# Lowest ANALYSIS_RATE R128 loudness may be measured at. K-weighting
+# boosts the high frequencies lost by resampling, so pink noise measures
+# 0.3 LU quieter at 32000, 0.8 LU at 22050 and 1.8 LU at 11025, enough
+# to change whether songs are exported.
+MIN_R128_RATE = 32000
+
+# Ways of decoding audiofiles when loading them, FFmpeg is used if the
+# chosen one isn't available or fails. See the decoders module.
+DECODERS = decoders.DECODERS
+
+# Names of results of _process_song, used in the report.
+# -3 is a song that raised an exception in a process, see _process_task.
+RESULTS = {0: 'exported', 1: 'copied', -1: 'load error', -2: 'export error',
+           -3: 'crashed'}
 
 CACHE_FILENAME = 'normalizer_cache.json'
+REPORT_FILENAME = 'normalizer_report.jsonl'
+SUMMARY_FILENAME = 'normalizer_report_summary.json'
 CONFIG_FILENAME = 'normalizer_config.ini'
 
 
-class ExceptionWrapper(object):
-    """Wrapper for exception to pass between processes."""
+class Task():
+    """Song to process, passed to a process of the Pool.
+
+    Holds only what the song is made from again in the process, see
+    _process_task. Settings are passed once to each process instead.
+
+    Attributes:
+        path (str):         path of song.
+        sources (dict):     stats of files in the song, see song.scan.
+        info (dict):        stream info of audiofiles already probed, by
+                            filename, so they aren't probed again.
+        volume (float):     cached volume of song, or None.
+        low_memory (bool):  whether the song should be spilled or streamed.
+    """
+
+    __slots__ = ('path', 'sources', 'info', 'volume', 'low_memory')
+
+    def __init__(self, path, sources, info, volume=None, low_memory=False):
+        self.path = path
+        self.sources = sources
+        self.info = info
+        self.volume = volume
+        self.low_memory = low_memory
 
-    def __init__(self, ee):
-        self.ee = ee
-        _,  _, self.tb = sys.exc_info()
 
-    def re_raise(self):
-        """Raises stored exception."""
-        raise self.ee.with_traceback(self.tb)
+class TaskResult():
+    """Result of a Task, passed back to the main process.
+
+    Attributes:
+        path (str):         path of song.
+        result (int):       return value of _process_song, -3 if an
+                            exception was raised.
+        cache_data (dict):  cache data of song.
+        timings (dict):     seconds of each step, see Song.timings.
+        seconds (float):    time it took to process the song.
+        error (str):        traceback of the exception raised, or None.
+    """
+
+    __slots__ = ('path', 'result', 'cache_data', 'timings', 'seconds',
+                 'error')
+
+    def __init__(self, path, result, cache_data, timings, seconds,
+                 error=None):
+        self.path = path
+        self.result = result
+        self.cache_data = cache_data
+        self.timings = timings
+        self.seconds = seconds
+        self.error = error
 
 
 class Normalizer():
     """Class for running a Normalizer instance.
 
     Can be started be running the 'run' method.
+
+    Attributes:
+        shard (tuple):  index and number of shards, see sharding. Only
+                        songs in this shard are processed, and files are
+                        written for the shard only. None for all songs.
     """
 
-    def __init__(self):
-        self.songs = []
+    def __init__(self, shard=None):
+        self.shard = shard
         self.cache = None
+        self.report = None
+        # Memory budget of songs in the pipeline, see _run_pipeline.
+        self._budget = None
+        self._reset_counts()
 
+    def _reset_counts(self):
+        """Resets the number of songs found, exported, copied and so on."""
         self.num_songs = 0
         self.num_export = 0
         self.num_copied = 0
         self.num_cached = 0
         self.num_errors = 0
 
+        self._start_time = time.time()
+        self._found_all = False
+
     def _load_config(self, filename):
         """Loads a config file. Creates one if none are found."""
         global TARGET_GAIN, HEADROOM, DEBUG_LOAD, DEBUG_EXPORT, MULTITHREADING
+        global ANALYSIS, EXPORT_SOURCE, LOSSLESS_MP3, FINGERPRINTS
+        global DISCOVERY_THREADS, SCHEDULING, MEMORY_BUDGET
+        global PIPELINE, ANALYZE_THREADS, ENCODE_THREADS, COPY_THREADS
+        global DECODE_THREADS, LINK_MODE, SETTLE_TIME, REPORT
+        global SAMPLE_WINDOWS, WINDOW_LENGTH, ANALYSIS_RATE, LOUDNESS
+        global DECODER, TASKS_PER_PROCESS, SPILL_SIZE
 
         default_config = configparser.ConfigParser()
         default_config['DEFAULT'] = {
@@ -74,6 +225,28 @@ class Normalizer():
             'load debug': DEBUG_LOAD,
             'export debug': DEBUG_EXPORT,
             'multithreading': MULTITHREADING,
+            'analysis': ANALYSIS,
+            'export from source': EXPORT_SOURCE,
+            'lossless mp3': LOSSLESS_MP3,
+            'fingerprints': FINGERPRINTS,
+            'discovery threads': DISCOVERY_THREADS,
+            'scheduling': SCHEDULING,
+            'memory budget': MEMORY_BUDGET,
+            'pipeline': PIPELINE,
+            'analyze threads': ANALYZE_THREADS,
+            'encode threads': ENCODE_THREADS,
+            'copy threads': COPY_THREADS,
+            'decode threads': DECODE_THREADS,
+            'link mode': LINK_MODE,
+            'settle time': SETTLE_TIME,
+            'report': REPORT,
+            'sample windows': SAMPLE_WINDOWS,
+            'window length': WINDOW_LENGTH,
+            'analysis sample rate': ANALYSIS_RATE,
+            'loudness': LOUDNESS,
+            'decoder': DECODER,
+            'tasks per process': TASKS_PER_PROCESS,
+            'spill size': SPILL_SIZE,
         }
 
         if os.path.isfile(filename):
@@ -83,11 +256,39 @@ class Normalizer():
                 config.read(filename)
 
                 assert 'DEFAULT' in config
+
+                # Add settings that are missing from older config files.
+                missing = False
                 for key in default_config['DEFAULT']:
-                    assert key in config['DEFAULT']
+                    if key not in config['DEFAULT']:
+                        config['DEFAULT'][key] = default_config['DEFAULT'][key]
+                        missing = True
 
                 assert int(config['DEFAULT']['target volume']) < 0
                 assert int(config['DEFAULT']['headroom']) >= 0
+                assert config['DEFAULT']['analysis'] in ANALYSIS_MODES
+                assert int(config['DEFAULT']['discovery threads']) > 0
+                assert config['DEFAULT']['scheduling'] in SCHEDULING_MODES
+                assert int(config['DEFAULT']['memory budget']) > 0
+                for key in ('analyze threads', 'encode threads',
+                            'copy threads', 'decode threads'):
+                    assert int(config['DEFAULT'][key]) > 0
+                assert config['DEFAULT']['link mode'] in LINK_MODES
+                assert float(config['DEFAULT']['settle time']) >= 0
+                assert int(config['DEFAULT']['sample windows']) >= 2
+                assert float(config['DEFAULT']['window length']) > 0
+                rate = int(config['DEFAULT']['analysis sample rate'])
+                assert rate >= 0
+                assert config['DEFAULT']['loudness'] in LOUDNESS_MODES
+                assert config['DEFAULT']['loudness'] != 'r128' or \
+                    rate == 0 or rate >= MIN_R128_RATE
+                assert config['DEFAULT']['decoder'] in DECODERS
+                assert int(config['DEFAULT']['tasks per process']) >= 0
+                assert int(config['DEFAULT']['spill size']) >= 0
+
+                if missing:
+                    with open(filename, 'w') as cf:
+                        config.write(cf)
             except Exception:
                 # Remake if bad config file.
                 print("Bad config, remaking.\n")
@@ -100,136 +301,533 @@ class Normalizer():
             DEBUG_LOAD = config['DEFAULT']['load debug'] == 'True'
             DEBUG_EXPORT = config['DEFAULT']['export debug'] == 'True'
             MULTITHREADING = config['DEFAULT']['multithreading'] == 'True'
+            ANALYSIS = config['DEFAULT']['analysis']
+            EXPORT_SOURCE = config['DEFAULT']['export from source'] == 'True'
+            LOSSLESS_MP3 = config['DEFAULT']['lossless mp3'] == 'True'
+            FINGERPRINTS = config['DEFAULT']['fingerprints'] == 'True'
+            DISCOVERY_THREADS = int(config['DEFAULT']['discovery threads'])
+            SCHEDULING = config['DEFAULT']['scheduling']
+            MEMORY_BUDGET = int(config['DEFAULT']['memory budget'])
+            PIPELINE = config['DEFAULT']['pipeline'] == 'True'
+            ANALYZE_THREADS = int(config['DEFAULT']['analyze threads'])
+            ENCODE_THREADS = int(config['DEFAULT']['encode threads'])
+            COPY_THREADS = int(config['DEFAULT']['copy threads'])
+            DECODE_THREADS = int(config['DEFAULT']['decode threads'])
+            LINK_MODE = config['DEFAULT']['link mode']
+            SETTLE_TIME = float(config['DEFAULT']['settle time'])
+            REPORT = config['DEFAULT']['report'] == 'True'
+            SAMPLE_WINDOWS = int(config['DEFAULT']['sample windows'])
+            WINDOW_LENGTH = float(config['DEFAULT']['window length'])
+            ANALYSIS_RATE = int(config['DEFAULT']['analysis sample rate'])
+            LOUDNESS = config['DEFAULT']['loudness']
+            DECODER = config['DEFAULT']['decoder']
+            TASKS_PER_PROCESS = int(config['DEFAULT']['tasks per process'])
+            SPILL_SIZE = int(config['DEFAULT']['spill size'])
         else:
             # Create new config file if none is found.
             with open(filename, 'w') as cf:
                 default_config.write(cf)
 
     def _load_cache(self, filename):
-        """Loads a cache file. Creates one if none are found."""
-        if os.path.isfile(filename):
-            try:
-                with open(filename) as cache_file:
-                    return json.load(cache_file)
-            except Exception:
-                print("Couldn't read cache file. Delete normalizer_cache.json")
-                input("\nPress enter to exit\n")
-                sys.exit()
-        else:
-            cache = {}
-            with open(filename, 'w') as cache_file:
-                json.dump(cache, cache_file, indent=2)
+        """Loads a cache file. Creates one if none are found.
 
-            return cache
+        A shard loads its own fragment of the cache, filled in with the
+        songs of the shard in the main cache, so songs processed by
+        earlier runs are still skipped. The main cache is only read.
+        """
+        cache = Cache(sharding.shard_filename(filename, self.shard))
+        try:
+            cache.load()
+            if self.shard is not None:
+                main = Cache(filename)
+                main.read()
+                for path, data in main.data.items():
+                    if path not in cache and self._in_shard(path):
+                        cache.data[path] = data
+        except Exception:
+            print("Couldn't read cache file. Delete " + cache.filename)
+            input("\nPress enter to exit\n")
+            sys.exit()
 
-    def _write_cache(self, filename, path, data):
-        """Writes new info to cache and cachefile."""
-        self.cache[path] = data
-        with open(filename, 'w') as cache_file:
+        return cache
+
+    def merge_cache(self):
+        """Merges the cache fragments of shards into the main cache.
+
+        The newest data of each song is kept, by when it was processed.
+        Fragments are removed once merged.
+        """
+        fragments = sharding.find_fragments(CACHE_FILENAME)
+        if len(fragments) == 0:
+            print("No cache fragments found.")
+            return
+
+        self.cache = self._load_cache(CACHE_FILENAME)
+        num_merged = 0
+        for filename in fragments:
+            fragment = Cache(filename)
             try:
-                json.dump(self.cache, cache_file, indent=2)
-            except:
-                # Try writing again if the first time was interrupted.
-                json.dump(self.cache, cache_file, indent=2)
-                raise
+                fragment.read()
+            except ValueError:
+                print("Couldn't read {}, skipping.".format(filename))
+                continue
+
+            for path, data in fragment.data.items():
+                old = self.cache.get(path)
+                if old is None or data.get('time', 0) > old.get('time', 0):
+                    self.cache.commit(path, data)
+                    num_merged += 1
+
+            self.cache.close()
+            os.remove(fragment.filename)
+            if os.path.isfile(fragment.journal_filename):
+                os.remove(fragment.journal_filename)
+            print("Merged", filename)
+
+        print("\n{} songs updated, {} songs in cache.".format(
+            num_merged, len(self.cache)))
+
+    def _in_shard(self, path):
+        """Returns whether the song in 'path' is processed by self.shard."""
+        if self.shard is None:
+            return True
+
+        relative = os.path.relpath(path, INPUT_FOLDER)
+        return sharding.shard_of(relative, self.shard[1]) == self.shard[0]
+
+    def _write_cache(self, path, data):
+        """Writes new info to cache and cachefile."""
+        self.cache.commit(path, data)
 
     def _find_songs(self, folder):
-        """Finds all folders that contain a notes file, i.e. all songs."""
-        songs = []
+        """Finds all folders that contain a notes file, i.e. all songs.
 
-        for root, dirs, files in os.walk(folder):
-            chart_exists = os.path.isfile(os.path.join(root, 'notes.chart'))
-            mid_exists = os.path.isfile(os.path.join(root, 'notes.mid'))
-            if chart_exists or mid_exists:
-                songs.append(Song(root))
+        Yields songs as they are found, counting them in self.num_songs.
+        Songs of other shards are left out.
+        """
+        self._found_all = False
+        for song in discovery.find_songs(folder, DISCOVERY_THREADS):
+            if not self._in_shard(song.path):
+                continue
+
+            self.num_songs += 1
+            yield song
+        self._found_all = True
+
+    def _output_path(self, song):
+        """Returns the path the Song object passed as argument is output to."""
+        return os.path.join(OUTPUT_FOLDER,
+                            os.path.relpath(song.path, INPUT_FOLDER))
+
+    def _plan_gain(self, volume):
+        """Returns gain to apply to a song with given volume, 0 if copied."""
+        gain_diff = TARGET_GAIN - volume
+        if abs(gain_diff) > HEADROOM:
+            return round(gain_diff, 2)
+        else:
+            return 0.0
 
-        # Sort songs by filename, not needed on Windows.
-        # songs.sort(key=lambda s: s.path)
-        return songs
+    def _check_estimate(self, volume, low, high):
+        """Returns True if an estimated volume can be used instead of analysis.
 
-    def _process_song(self, song):
-        """processes the Song object passed as argument.
+        The estimate is good enough if the song would be copied or exported
+        anywhere between 'low' and 'high', and if exported, the gain is off
+        by no more than HEADROOM.
+        """
+        if (self._plan_gain(low) == 0) != (self._plan_gain(high) == 0):
+            return False
 
-        Loads audio, analyzes volume, then exports audiofiles with gain
-        so that the song has the correct volume.
-        Copies song if within HEADROOM of TARGET_GAIN.
+        return max(volume - low, high - volume) <= HEADROOM
+
+    def _cached_volume(self, song):
+        """Returns cached volume of scanned Song object, None if unknown."""
+        if song.path not in self.cache:
+            return None
+
+        return song.cached_volume(self.cache[song.path], LOUDNESS,
+                                  FINGERPRINTS)
+
+    def _check_cache(self, song):
+        """Checks if the scanned Song object passed as argument is cached.
+
+        Songs are cached if they haven't changed, and would be exported with
+        the same gain as last time with the current settings.
+        """
+        if song.path not in self.cache:
+            return False
+
+        data = self.cache[song.path]
+        if not song.check_cache(data, self._output_path(song), FINGERPRINTS):
+            return False
+
+        # Volumes measured another way than LOUDNESS are measured again.
+        if self._measured_otherwise(song):
+            return False
+
+        # Songs from older versions and songs with errors have no volume.
+        volume = self._cached_volume(song)
+        return volume is None or self._plan_gain(volume) == data.get('gain')
+
+    def _measured_otherwise(self, song):
+        """Returns whether the cached volume of a song isn't of LOUDNESS.
+
+        Cache data without a volume, or without a measure, from older
+        versions, has no volume to measure again.
+        """
+        data = self.cache.get(song.path, {})
+        return data.get('volume') is not None and \
+            data.get('measure', LOUDNESS) != LOUDNESS
+
+    def _check_song(self, song):
+        """Scans the Song object passed as argument and checks the cache.
+
+        Returns:
+            tuple: whether song is cached, and its cached volume or None.
         """
         song.scan_files()
+        return self._check_cache(song), self._cached_volume(song)
 
-        # Check if song is in cache and is not changed.
-        if song.path in self.cache and song.check_cache(self.cache[song.path]):
-            print("  Song in cache, skipping.")
-            return 2
+    def _check_songs(self, songs):
+        """Checks songs against the cache in parallel, as they are found.
 
-        # Load audiofiles, error if no audio was loaded.
-        if not song.load_files(indent=2, debug=DEBUG_LOAD):
-            print("\n  Couldn't load any audio, skipping.")
-            return -1
+        Counts cached songs in self.num_cached.
+
+        Yields:
+            tuple: uncached Song object and its cached volume or None.
+        """
+        songs = iter(songs)
+        with ThreadPoolExecutor(DISCOVERY_THREADS) as executor:
+            pending = {}
+            while True:
+                # Keep a couple of songs queued for each thread.
+                for s in itertools.islice(
+                        songs, 2 * DISCOVERY_THREADS - len(pending)):
+                    pending[executor.submit(self._check_song, s)] = s
+
+                if len(pending) == 0:
+                    break
+
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    s = pending.pop(future)
+                    cached, volume = future.result()
+                    if cached:
+                        print("In cache:", s.path)
+                        self.num_cached += 1
+                    else:
+                        yield s, volume
+
+    def _plan_memory(self, song, volume):
+        """Estimates how much memory processing a song needs.
+
+        Only songs that are loaded whole need more than a little memory.
+        Songs bigger than SPILL_SIZE, or that don't fit in MEMORY_BUDGET
+        even on their own, are spilled to disk instead, see _analyze_song.
+
+        Args:
+            song (Song):        scanned song.
+            volume (float):     cached volume of song, None if not cached.
+
+        Returns:
+            tuple: estimated memory in bytes, and whether the song should be
+                processed using as little memory as possible.
+        """
+        if volume is not None or ANALYSIS != 'full':
+            return scheduler.BASE_MEMORY, False
+
+        memory = scheduler.estimate_memory(song)
+        spill = SPILL_SIZE and memory > SPILL_SIZE * 2 ** 20
+        if spill or memory > MEMORY_BUDGET * 2 ** 20:
+            how = 'spilling' if self._can_spill() else 'streaming'
+            print("Too big to load, {}: {} ({} MB)".format(
+                how, song.path, memory // 2 ** 20))
+            return scheduler.BASE_MEMORY, True
+
+        return memory, False
+
+    def _can_spill(self):
+        """Returns whether songs too big to load can be spilled to disk.
+
+        Spilled audio is mixed from disk a block at a time using NumPy,
+        without it the song would be copied to memory anyway.
+        """
+        return SPILL_SIZE > 0 and loudness is not None
+
+    def _plan_tasks(self, tasks):
+        """Plans memory of songs from _check_songs for the Scheduler.
+
+        Yields:
+            tuple: Task for _process_task, and its estimated memory.
+        """
+        for song, volume in tasks:
+            memory, low_memory = self._plan_memory(song, volume)
+            info = {a.filename: a.info for a in song.files if a.info}
+            yield Task(song.path, song.sources, info, volume,
+                       low_memory), memory
+
+    def _plan_jobs(self, tasks):
+        """Plans memory of songs from _check_songs for the pipeline.
+
+        Yields:
+            dict: job for the stages of _run_pipeline.
+        """
+        for song, volume in tasks:
+            memory, low_memory = self._plan_memory(song, volume)
+            yield {'song': song, 'volume': volume, 'gain': None,
+                   'result': None, 'error': None, 'memory': memory,
+                   'low_memory': low_memory}
+
+    def _analyze_song(self, song, volume=None, low_memory=False):
+        """Analyzes the volume of the scanned Song object passed as argument.
+
+        Loads or streams audio depending on ANALYSIS, at ANALYSIS_RATE if
+        set. Audio that can be piped when exporting is kept loaded, see
+        Song.unload_unpiped, unless EXPORT_SOURCE or ANALYSIS_RATE is set.
+
+        Args:
+            song (Song):        scanned song.
+            volume (float):     cached volume of song, if given the song is
+                                only probed instead of analyzed.
+            low_memory (bool):  whether the song should be spilled to
+                                disk, or streamed, instead of loaded.
+
+        Returns:
+            float: volume of song in dBFS or LUFS, None if no audio was
+                loaded.
+        """
+        analysis = ANALYSIS
+        spill = None
+        if low_memory and ANALYSIS == 'full':
+            if self._can_spill():
+                spill = sharding.shard_filename(SPILL_FOLDER, self.shard)
+            else:
+                analysis = 'stream'
+        sample_rate = ANALYSIS_RATE or None
+        decoder = decoders.get_decoder(DECODER)
+        if LOUDNESS == 'r128' and loudness is None:
+            analysis = 'ffmpeg'
+
+        if volume is not None:
+            # Only probe audiofiles, they are decoded when exporting.
+            print("  Volume in cache, skipping analysis.")
+            if not song.probe_files(indent=2, decoder=decoder):
+                return None
+        elif analysis in ('stream', 'ffmpeg', 'sampled'):
+            # Probe audiofiles, audio is only decoded while analyzing.
+            if not song.probe_files(indent=2, decoder=decoder):
+                return None
+
+            if analysis == 'ffmpeg':
+                volume = song.get_volume_ffmpeg(debug=DEBUG_LOAD,
+                                                measure=LOUDNESS)
+                if volume is None and loudness is None and LOUDNESS == 'r128':
+                    return None
+                elif volume is None:
+                    # Streaming finds and skips audiofiles that can't be read.
+                    print("  FFmpeg couldn't analyze song, streaming instead.")
+            elif analysis == 'sampled':
+                estimate = song.get_volume_sampled(
+                    SAMPLE_WINDOWS, WINDOW_LENGTH, threads=DECODE_THREADS,
+                    debug=DEBUG_LOAD, sample_rate=sample_rate,
+                    measure=LOUDNESS)
+                if estimate is None:
+                    print("  Song too short to sample, streaming instead.")
+                elif not self._check_estimate(*estimate):
+                    print("  Volume between {:.1f} and {:.1f} {}, streaming "
+                          "instead.".format(*estimate[1:], UNITS[LOUDNESS]))
+                else:
+                    volume = estimate[0]
+
+            if volume is None:
+                volume = song.get_volume_stream(indent=2, debug=DEBUG_LOAD,
+                                                sample_rate=sample_rate,
+                                                measure=LOUDNESS)
+        else:
+            # Probe first, so it is timed apart from decoding.
+            if not song.probe_files(indent=2, decoder=decoder):
+                return None
+
+            # Load audiofiles, error if no audio was loaded.
+            if not song.load_files(indent=2, debug=DEBUG_LOAD,
+                                   threads=DECODE_THREADS,
+                                   sample_rate=sample_rate, decoder=decoder,
+                                   spill=spill):
+                return None
+
+            volume = song.get_volume(LOUDNESS, sample_rate)
+
+            # Free audio now, it is decoded again when exporting. Audio
+            # loaded at ANALYSIS_RATE can't be exported.
+            if EXPORT_SOURCE or sample_rate is not None:
+                song.unload_files()
+            else:
+                song.unload_unpiped()
+
+        return volume
 
+    def _export_song(self, song, gain_diff):
+        """Exports audiofiles of the analyzed Song object with gain.
+
+        Returns:
+            bool: True if any audio was exported, False otherwise.
+        """
         # Create new song folder if it doesn't exist.
-        new_path = os.path.join(OUTPUT_FOLDER, song.path.partition('\\')[2])
-        if not os.path.isdir(new_path):
-            os.makedirs(new_path)
+        new_path = self._output_path(song)
+        os.makedirs(new_path, exist_ok=True)
+
+        # MP3 gain may be rounded as long as the song ends up within
+        # HEADROOM of TARGET_GAIN.
+        tolerance = HEADROOM if LOSSLESS_MP3 else None
+
+        if not song.export(new_path, gain_diff, indent=2,
+                           debug=DEBUG_EXPORT, tolerance=tolerance):
+            shutil.rmtree(new_path)
+            return False
+
+        return True
+
+    def _copy_song(self, song, volume, gain_diff):
+        """Copies the files of the Song object that aren't exported.
+
+        Audiofiles are copied too if 'gain_diff' is 0. Stores the state of
+        the song and its output in song.cache_data, along with its volume,
+        so it doesn't have to be analyzed again.
+        """
+        new_path = self._output_path(song)
+        os.makedirs(new_path, exist_ok=True)
+
+        if gain_diff == 0:
+            song.copy(new_path, link_mode=LINK_MODE)
+
+        # Copy remaining files.
+        song.copy(new_path, audio=False, link_mode=LINK_MODE)
+
+        song.make_cache_data(new_path, FINGERPRINTS)
+        song.cache_data['volume'] = volume
+        song.cache_data['measure'] = LOUDNESS
+        song.cache_data['gain'] = gain_diff
+        # When the song was processed, the newest is kept when merging.
+        song.cache_data['time'] = round(time.time(), 3)
+
+        # Remove loaded audiofiles to clean up memory and spilled audio.
+        song.unload_files()
+        song.files = []
+
+    def _process_song(self, song, volume=None, low_memory=False):
+        """processes the scanned Song object passed as argument.
+
+        Loads audio, analyzes volume, then exports audiofiles with gain
+        so that the song has the correct volume.
+        Copies song if within HEADROOM of TARGET_GAIN.
+        If 'volume' is given, it is used instead of analyzing the song.
+        If 'low_memory' is True, the song is spilled to disk or streamed
+        instead of loaded.
+        """
+        volume = self._analyze_song(song, volume, low_memory)
+        if volume is None:
+            print("\n  Couldn't load any audio, skipping.")
+            return -1
 
-        volume = song.get_volume()
-        print('\n  Volume: {:.1f} dBFS.'.format(volume))
+        print('\n  Volume: {:.1f} {}.'.format(volume, UNITS[LOUDNESS]))
 
         # Export if gain difference is bigger than HEADROOM.
-        exported = True
-        gain_diff = TARGET_GAIN - volume
-        if abs(gain_diff) > HEADROOM:
+        gain_diff = self._plan_gain(volume)
+        if gain_diff != 0:
             print("  Applying {:.1f} dB of gain.\n".format(gain_diff))
+
             # Export audiofiles, error if no was exported.
-            if not song.export(new_path, gain_diff,
-                               indent=2, debug=DEBUG_EXPORT):
+            if not self._export_song(song, gain_diff):
                 print("\n  Couldn't export any audio, skipping.")
-                shutil.rmtree(new_path)
                 return -2
         else:
             # Copy if within HEADROOM dB.
             print("  Song within {} dB of target, copying files.".format(
                 HEADROOM))
-            song.copy(new_path)
-            exported = False
 
-        # Copy remaining files.
-        song.copy(new_path, audio=False)
+        self._copy_song(song, volume, gain_diff)
 
-        # Remove loaded audiofiles to clean up memory.
-        song.files = []
-        if exported:
+        if gain_diff != 0:
             return 0
         else:
             return 1
 
-    def _process_song_mp(self, song):
-        """Wrapper method for processing song whit multiprocessing.
+    def _analyze_stage(self, job):
+        """Pipeline stage analyzing a song, see _run_pipeline.
 
-        Disables output from processing method. Passes result to main
-        process with a queue.
-        Passes ExceptionWrapper if exception is encountered.
+        Waits for the memory the song is estimated to need to fit in
+        MEMORY_BUDGET first. It is held until its audio is freed.
         """
+        job['memory'] = self._budget.acquire(job['memory'])
+        job['start'] = time.perf_counter()
+        try:
+            job['volume'] = self._analyze_song(
+                job['song'], job['volume'], job['low_memory'])
+            if job['volume'] is None:
+                job['result'] = -1
+                self._release_job(job)
+                return None, job
+
+            job['gain'] = self._plan_gain(job['volume'])
+            if job['gain'] != 0:
+                # Only audio that is piped is still held, give back the
+                # memory of the rest.
+                held = min(scheduler.loaded_memory(job['song']),
+                           job['memory'])
+                self._budget.release(job['memory'] - held)
+                job['memory'] = held
+                return 'encode', job
+
+            # Audio is copied as it is, it isn't needed anymore.
+            self._release_job(job)
+            return 'copy', job
+        except Exception:
+            return self._crash_job(job)
+
+    def _encode_stage(self, job):
+        """Pipeline stage exporting audio of a song, see _run_pipeline."""
+        try:
+            exported = self._export_song(job['song'], job['gain'])
+            self._release_job(job)
+        except Exception:
+            return self._crash_job(job)
+
+        if not exported:
+            job['result'] = -2
+            return None, job
+
+        return 'copy', job
+
+    def _copy_stage(self, job):
+        """Pipeline stage copying the rest of a song, see _run_pipeline."""
         try:
-            print("Processing", song.path)
+            self._copy_song(job['song'], job['volume'], job['gain'])
+        except Exception:
+            return self._crash_job(job)
 
-            # Disable console output.
-            original_stdout, original_stderr = sys.stdout, sys.stderr
-            new_stdout = open(os.devnull, 'w')
-            sys.stdout = sys.stderr = new_stdout
+        job['result'] = 0 if job['gain'] != 0 else 1
+        return None, job
 
-            result = self._process_song(song)
-            queue.put((result, song.path, song.cache_data))
+    def _release_job(self, job):
+        """Frees audio of a pipeline job, and gives back its memory."""
+        try:
+            job['song'].unload_files()
+        finally:
+            self._budget.release(job['memory'])
+            job['memory'] = 0
 
-            # Enable console output.
-            sys.stdout, sys.stderr = original_stdout, original_stderr
-            new_stdout.close()
-        except Exception as e:
-            queue.put(ExceptionWrapper(e))
+    def _crash_job(self, job):
+        """Ends a pipeline job whose stage raised an exception.
 
-    def _init_mp(self, q):
-        """Initializes the queue for child processes."""
-        global queue
-        queue = q
+        Only this song fails, like in _process_task, and the traceback is
+        kept in the job so it can be printed. Its memory is given back
+        even if its audio can't be freed.
+        """
+        job['result'], job['error'] = -3, traceback.format_exc()
+        try:
+            self._release_job(job)
+        except Exception:
+            pass
+        return None, job
 
     def _update_num(self, result):
         """Updates num attributes based on result passed as argument."""
@@ -239,75 +837,279 @@ class Normalizer():
             2: 'num_cached',
             -1: 'num_errors',
             -2: 'num_errors',
+            -3: 'num_errors',
         }
 
         setattr(self, num[result], getattr(self, num[result]) + 1)
 
-    def _run(self, start_time):
-        """processes all songs found with find_songs method.
+    def _finish_song(self, path, result, cache_data, timings, seconds):
+        """Counts, reports and caches a processed song.
+
+        Args:
+            path (str):         path of song.
+            result (int):       return value of _process_song.
+            cache_data (dict):  cache data of song.
+            timings (dict):     seconds of each step, see Song.timings.
+            seconds (float):    time it took to process the song.
+        """
+        self._update_num(result)
+        if self.report is not None:
+            self.report.add(path, RESULTS[result], seconds, timings,
+                            cache_data)
+        # Leave crashed songs out of the cache, so they're tried again.
+        if result != -3:
+            self._write_cache(path, cache_data)
+
+    def _print_progress(self):
+        """Prints number of songs processed, throughput and time left.
+
+        Time left is only estimated once all songs have been found.
+        """
+        done = self.num_export + self.num_copied + self.num_errors
+        seconds = time.time() - self._start_time
+        rate = done / seconds if seconds > 0 else 0.0
+
+        text = "{} done, {:.2f} songs/s".format(done, rate)
+        if self._found_all:
+            left = self.num_songs - self.num_cached - done
+            text += ", {} left".format(left)
+            if rate > 0:
+                text += ", ETA {}".format(
+                    datetime.timedelta(seconds=int(left / rate)))
+        print(text)
+
+    def _run(self, songs, start_time):
+        """processes all songs passed as argument.
 
         For use when multithreading is disabled.
         """
-        for i, s in enumerate(self.songs):
+        for i, s in enumerate(songs):
             time_used = int(time.time() - start_time)
-            print("Song {}/{}".format(i + 1, self.num_songs))
+            print("Song {}".format(i + 1))
             print("Time:", datetime.timedelta(seconds=time_used))
             print(s.path)
 
-            result = self._process_song(s)
-
-            self._update_num(result)
-            if result != 2:
-                self._write_cache(CACHE_FILENAME, s.path, s.cache_data)
+            # Check if song is in cache and is not changed.
+            cached, volume = self._check_song(s)
+            if cached:
+                print("  Song in cache, skipping.")
+                self._update_num(2)
+            else:
+                _, low_memory = self._plan_memory(s, volume)
+                start = time.perf_counter()
+                result = self._process_song(s, volume, low_memory)
+                self._finish_song(s.path, result, s.cache_data, s.timings,
+                                  time.perf_counter() - start)
+                self._print_progress()
 
             print()
 
-    def _run_mp(self):
-        """Same as _run, but uses multithreading."""
-        # Skip all songs that are found in cache until uncached song is found.
-        start = 0
-        for i, s in enumerate(self.songs):
-            s.scan_files()
-            if s.path in self.cache and s.check_cache(self.cache[s.path]):
-                print("In cache:", s.path)
-                self.num_cached += 1
-            else:
-                # Remove scanned files, as they are scanned when the song
-                # is processed.
-                s.files = []
-                s.cache_data = {}
-
-                start = i
-                break
+    def _schedule(self, songs):
+        """Filters out cached songs and orders the rest by SCHEDULING.
 
-        queue = multiprocessing.Queue()
-        with multiprocessing.Pool(initializer=self._init_mp,
-                                  initargs=(queue,)) as pool:
-            pool.map_async(self._process_song_mp, self.songs[start:], 1)
+        Returns:
+            iterable: (Song, cached volume or None) tuples.
+        """
+        tasks = self._check_songs(songs)
+        if SCHEDULING == 'largest first':
+            tasks = sorted(tasks, key=lambda t: t[0].audio_size(),
+                           reverse=True)
+            print("\n{} songs to process.\n".format(len(tasks)))
+
+        return tasks
+
+    def _run_mp(self, songs):
+        """Same as _run, but uses multithreading.
+
+        Cached songs are filtered out in parallel before any song is passed
+        to the processes. Depending on SCHEDULING, songs are then passed on
+        as they are found, or biggest first once all are found, so big
+        songs aren't left processing alone at the end.
+        Songs are only started while the memory they are estimated to need
+        stays within MEMORY_BUDGET.
+        Processes are replaced after TASKS_PER_PROCESS songs, returning
+        memory left fragmented by big audio buffers. A song raising an
+        exception is counted as an error, and the rest are processed.
+        """
+        tasks = self._schedule(songs)
+
+        processes = os.cpu_count() or 1
+        schedule = scheduler.Scheduler(MEMORY_BUDGET * 2 ** 20, processes)
+        settings = {name: globals()[name] for name in SETTINGS}
+        with multiprocessing.Pool(processes, _init_worker,
+                                  (settings, self.shard),
+                                  TASKS_PER_PROCESS or None) as pool:
+            results = schedule.run(pool, _process_task,
+                                   self._plan_tasks(tasks))
+
+            for r in results:
+                self._finish_song(r.path, r.result, r.cache_data, r.timings,
+                                  r.seconds)
+
+                if r.result == -1:
+                    print("\n{}\n  "
+                          "Error, couldn't load audio\n".format(r.path))
+                elif r.result == -2:
+                    print("\n{}\n  "
+                          "Error, couldn't export audio\n".format(r.path))
+                elif r.result == -3:
+                    print("\n{}\n  Error, crashed while processing:\n\n{}"
+                          .format(r.path, r.error))
+
+                self._print_progress()
+
+    def _run_pipeline(self, songs):
+        """Same as _run, but runs each step of processing in its own threads.
+
+        Songs go through an analyze, an encode and a copy stage, each run
+        by its own number of threads, so songs are analyzed while others
+        are exported or copied. The decoding and encoding itself is done by
+        FFmpeg processes, which the threads wait for.
+        Songs are only analyzed while the memory of songs whose audio is
+        held, waiting for or being exported, stays within MEMORY_BUDGET.
+        """
+        self._budget = scheduler.MemoryBudget(MEMORY_BUDGET * 2 ** 20)
+
+        pipe = pipeline.Pipeline()
+        pipe.add_stage('analyze', self._analyze_stage, ANALYZE_THREADS)
+        pipe.add_stage('encode', self._encode_stage, ENCODE_THREADS)
+        pipe.add_stage('copy', self._copy_stage, COPY_THREADS)
+
+        for job in pipe.run(self._plan_jobs(self._schedule(songs))):
+            s, r = job['song'], job['result']
+            self._finish_song(s.path, r, s.cache_data, s.timings,
+                              time.perf_counter() - job['start'])
+
+            if r == -1:
+                print("\n{}\n  "
+                      "Error, couldn't load audio\n".format(s.path))
+            elif r == -2:
+                print("\n{}\n  "
+                      "Error, couldn't export audio\n".format(s.path))
+            elif r == -3:
+                print("\n{}\n  Error, crashed while processing:\n\n{}"
+                      .format(s.path, job['error']))
+            else:
+                print("Processed", s.path)
 
-            num_processed = self.num_cached
-            while num_processed < self.num_songs:
-                data = queue.get()
+            self._print_progress()
 
-                if isinstance(data, ExceptionWrapper):
-                    data.re_raise()
+    def replan(self):
+        """Lists songs that would be processed differently with current config.
 
-                r, path, cache_data = data
-                self._update_num(r)
+        Uses the volumes stored in the cache, so no audio is touched.
+        """
+        self._load_config(CONFIG_FILENAME)
+        self.cache = self._load_cache(CACHE_FILENAME)
 
-                if r == -1:
-                    print("\n{}\n  "
-                          "Error, couldn't load audio\n".format(path))
-                elif r == -2:
-                    print("\n{}\n  "
-                          "Error, couldn't export audio\n".format(path))
+        print("Finding songs...\n")
 
-                # Don't update cache when song was skipped because of cache.
-                if r != 2:
-                    self._write_cache(CACHE_FILENAME, path, cache_data)
+        num_changed = 0
+        num_unknown = 0
+        for s in self._find_songs(INPUT_FOLDER):
+            s.scan_files()
+            if self._measured_otherwise(s):
+                num_changed += 1
+                print(s.path)
+                print("  Volume measured as {}, analyzed again as {}\n"
+                      .format(self.cache[s.path]['measure'], LOUDNESS))
+                continue
+
+            volume = self._cached_volume(s)
+            if volume is None:
+                num_unknown += 1
+                continue
+
+            old_gain = self.cache[s.path].get('gain')
+            new_gain = self._plan_gain(volume)
+            if new_gain != old_gain:
+                num_changed += 1
+                print(s.path)
+                print("  Volume: {:.1f} {}, {} -> {}\n".format(
+                      volume, UNITS[LOUDNESS], self._describe_gain(old_gain),
+                      self._describe_gain(new_gain)))
+
+        print("  Changed:  {:>5}".format(num_changed))
+        print("  Same:     {:>5}".format(
+            self.num_songs - num_changed - num_unknown))
+        print("  Unknown:  {:>5}".format(num_unknown))
+
+        self.cache.close()
+
+    def _describe_gain(self, gain):
+        """Describes what is done to a song with given planned gain."""
+        if gain is None:
+            return "error"
+        elif gain == 0:
+            return "copy"
+        else:
+            return "export with {:+.1f} dB".format(gain)
+
+    def _print_mode(self):
+        """Prints how songs are processed, if not the default way."""
+        if LOUDNESS == 'r128' and loudness is None:
+            print("NumPy not found, measuring loudness with FFmpeg.\n")
+
+        if self.shard is not None:
+            print("Processing shard {} of {}.\n".format(*self.shard))
+
+        if PIPELINE:
+            print("Pipeline enabled.")
+            print("Running {} analyze, {} encode and {} copy threads.\n"
+                  .format(ANALYZE_THREADS, ENCODE_THREADS, COPY_THREADS))
+        elif MULTITHREADING:
+            print("Multithreading enabled.")
+            print("Running {} processes.\n".format(os.cpu_count()))
+
+    def _process_songs(self, songs, start_time):
+        """Processes songs the way set in the config."""
+        self._start_time = start_time
+        # Other shards may be using the output folder, so only clear the
+        # spill folder of this one.
+        spill = sharding.shard_filename(SPILL_FOLDER, self.shard)
+        shutil.rmtree(spill, ignore_errors=True)
+        try:
+            if PIPELINE:
+                self._run_pipeline(songs)
+            elif MULTITHREADING:
+                self._run_mp(songs)
+            else:
+                self._run(songs, start_time)
+        finally:
+            shutil.rmtree(spill, ignore_errors=True)
+
+    def _open_report(self):
+        """Starts a new report if enabled in the config."""
+        if REPORT:
+            self.report = Report(
+                sharding.shard_filename(REPORT_FILENAME, self.shard),
+                sharding.shard_filename(SUMMARY_FILENAME, self.shard))
+
+    def _close_report(self):
+        """Writes the summary of the report and closes it."""
+        if self.report is not None:
+            self.report.write_summary()
+            self.report.close()
+
+    def _print_summary(self, start_time):
+        """Prints the number of songs of each result, and time used."""
+        time_used = datetime.timedelta(seconds=int(time.time() - start_time))
+        print("  Found:    {:>5}".format(self.num_songs))
+        print("  Exported: {:>5}".format(self.num_export))
+        print("  Copied:   {:>5}".format(self.num_copied))
+        print("  Cached:   {:>5}".format(self.num_cached))
+        print("  Errors:   {:>5}".format(self.num_errors))
+        print("\nTime used:", str(time_used))
 
-                num_processed = self.num_cached + self.num_copied \
-                    + self.num_errors + self.num_export
+    def _log_crash(self):
+        """Writes the exception being handled to crash_log.txt."""
+        time.sleep(0.1)
+        print("\n!!! CRASH !!!\nSee crash_log.txt for info.\n")
+        logging.basicConfig(filename='crash_log.txt', filemode='w')
+        logging.exception(
+            "\n\nSomething bad happened.\n"
+            "Send this to Clysop. (Discord: Clysop#3650)\n\n"
+            )
 
     def run(self):
         """Runs Normalizer program."""
@@ -316,20 +1118,12 @@ class Normalizer():
 
             self._load_config(CONFIG_FILENAME)
             self.cache = self._load_cache(CACHE_FILENAME)
+            self._open_report()
+            self._print_mode()
 
-            if MULTITHREADING:
-                print("Multithreading enabled.")
-                print("Running {} processes.\n".format(os.cpu_count()))
-
-            print("Finding songs...")
-            self.songs = self._find_songs(INPUT_FOLDER)
-            self.num_songs = len(self.songs)
-            print("Found {} songs.\n".format(self.num_songs))
-
-            if MULTITHREADING:
-                self._run_mp()
-            else:
-                self._run(start_time)
+            # Songs are processed while the rest are being found.
+            print("Finding songs...\n")
+            self._process_songs(self._find_songs(INPUT_FOLDER), start_time)
 
         except KeyboardInterrupt:
             # Sleep incase debug is on, which can couse strange output
@@ -337,26 +1131,148 @@ class Normalizer():
             time.sleep(0.1)
             print("\nInterrupted.\n")
         except Exception:
-            time.sleep(0.1)
-            print("\n!!! CRASH !!!\nSee crash_log.txt for info.\n")
-            logging.basicConfig(filename='crash_log.txt', filemode='w')
-            logging.exception(
-                "\n\nSomething bad happened.\n"
-                "Send this to Clysop. (Discord: Clysop#3650)\n\n"
-                )
+            self._log_crash()
         else:
             print("Done!\n")
 
-        time_used = datetime.timedelta(seconds=int(time.time() - start_time))
-        print("  Exported: {:>5}".format(self.num_export))
-        print("  Copied:   {:>5}".format(self.num_copied))
-        print("  Cached:   {:>5}".format(self.num_cached))
-        print("  Errors:   {:>5}".format(self.num_errors))
-        print("\nTime used:", str(time_used))
+        if self.cache is not None:
+            self.cache.close()
+        self._close_report()
+
+        self._print_summary(start_time)
+        if self.report is not None:
+            print()
+            self.report.print_summary()
+            print("Report written to", self.report.filename)
 
         input("\nPress enter to exit\n")
 
+    def watch(self):
+        """Runs Normalizer, then keeps processing songs as they change.
+
+        Songs added or changed in INPUT_FOLDER are processed once their
+        files have stayed the same for SETTLE_TIME seconds. The config and
+        cache stay loaded in between. Runs until interrupted.
+        """
+        start_time = time.time()
+        try:
+            self._load_config(CONFIG_FILENAME)
+            self.cache = self._load_cache(CACHE_FILENAME)
+            self._open_report()
+            self._print_mode()
+
+            # Catch up on songs changed since the last run.
+            print("Finding songs...\n")
+            self._process_songs(self._find_songs(INPUT_FOLDER), start_time)
+            print("Done!\n")
+            self._print_summary(start_time)
+
+            print("\nWatching {} for new and changed songs. "
+                  "Press Ctrl+C to stop.\n".format(INPUT_FOLDER))
+            for folders in watch.watch(INPUT_FOLDER, SETTLE_TIME):
+                start_time = time.time()
+                self._reset_counts()
+
+                songs = itertools.chain.from_iterable(
+                    self._find_songs(f) for f in folders)
+                self._process_songs(songs, start_time)
+
+                if self.num_songs > 0:
+                    print("Done!\n")
+                    self._print_summary(start_time)
+                    print()
+
+                if self.report is not None:
+                    self.report.write_summary()
+
+        except KeyboardInterrupt:
+            time.sleep(0.1)
+            print("\nStopped watching.\n")
+        except Exception:
+            self._log_crash()
+
+        if self.cache is not None:
+            self.cache.close()
+        self._close_report()
+
+
+# Normalizer of a process of the Pool, see _init_worker.
+_worker = None
+
+
+def _init_worker(settings, shard=None):
+    """Sets up a process of the Pool used when multithreading.
+
+    Args:
+        settings (dict):    values of SETTINGS in the main process, which
+                            processes that aren't forked don't have.
+        shard (tuple):      shard being processed, see Normalizer.shard.
+    """
+    global _worker
+    globals().update(settings)
+    _worker = Normalizer(shard)
+
+
+def _process_task(task):
+    """Processes the song of a Task in a process of the Pool.
+
+    Disables console output while processing. Exceptions are returned
+    in the result instead of being raised, so only this song fails.
+
+    Returns:
+        TaskResult: result of processing the song.
+    """
+    print("Processing", task.path)
+    start = time.perf_counter()
+    song = Song(task.path, task.sources)
+
+    # Disable console output.
+    original_stdout, original_stderr = sys.stdout, sys.stderr
+    new_stdout = open(os.devnull, 'w')
+    sys.stdout = sys.stderr = new_stdout
+    try:
+        song.scan_files()
+        for a in song.files:
+            a.info = task.info.get(a.filename, {})
+        result = _worker._process_song(song, task.volume, task.low_memory)
+        error = None
+    except Exception:
+        result, error = -3, traceback.format_exc()
+    finally:
+        # Enable console output.
+        sys.stdout, sys.stderr = original_stdout, original_stderr
+        new_stdout.close()
+
+    return TaskResult(task.path, result, song.cache_data, song.timings,
+                      time.perf_counter() - start, error)
+
 
 if __name__ == '__main__':
     multiprocessing.freeze_support()
-    Normalizer().run()
+
+    parser = argparse.ArgumentParser(
+        description="Normalizes the volume of a Clone Hero library.")
+    parser.add_argument(
+        '--replan', action='store_true',
+        help="list songs that would change with the current config, "
+             "using cached volumes, without processing anything")
+    parser.add_argument(
+        '--watch', action='store_true',
+        help="keep running, processing songs as they are added or changed")
+    parser.add_argument(
+        '--shard', type=sharding.parse_shard, metavar='i/N',
+        help="only process shard i of N of the songs, writing its own cache "
+             "fragment, so several machines can share a library")
+    parser.add_argument(
+        '--merge-cache', action='store_true',
+        help="merge the cache fragments written by shards into the cache")
+    args = parser.parse_args()
+
+    if args.merge_cache:
+        Normalizer().merge_cache()
+    elif args.replan:
+        Normalizer(args.shard).replan()
+    elif args.watch:
+        Normalizer(args.shard).watch()
+    else:
+        Normalizer(args.shard).run()
@@ -0,0 +1,156 @@
+"""Runs items through stages of worker threads connected by bounded queues.
+
+Written by Clysop.
+"""
+
+import sys
+import queue
+import threading
+from collections import OrderedDict
+
+# Max number of items waiting for each stage.
+QUEUE_SIZE = 2
+
+# Marks threads whose output is dropped by QuietOutput.
+_thread_state = threading.local()
+
+
+class QuietOutput():
+    """Replaces an output stream, dropping all output of pipeline threads.
+
+    Output of other threads, like the main thread, is written as usual.
+    """
+
+    def __init__(self, stream):
+        self.stream = stream
+
+    def write(self, text):
+        if not getattr(_thread_state, 'quiet', False):
+            return self.stream.write(text)
+        return len(text)
+
+    def flush(self):
+        self.stream.flush()
+
+    def __getattr__(self, name):
+        return getattr(self.stream, name)
+
+
+class Pipeline():
+    """Class for running items through stages, each with its own threads.
+
+    Each stage has a function and a number of threads running it, and a
+    bounded queue of items waiting for it. A stage function takes an item
+    and returns the name of the stage it goes to next, None if it is done,
+    along with the item. A stage waits while the next stage's queue is
+    full, so no stage gets far ahead of the others.
+
+    Stages that mostly wait for other processes, like FFmpeg, or for the
+    disk, run well in threads.
+
+    Attributes:
+        stages (OrderedDict):   (function, threads) of each stage, by name.
+    """
+
+    def __init__(self):
+        self.stages = OrderedDict()
+
+    def add_stage(self, name, func, threads):
+        """Adds a stage. Items enter the pipeline at the first stage added.
+
+        Args:
+            name (str):         name of stage.
+            func (callable):    function run on each item, see Pipeline.
+            threads (int):      number of threads running the stage.
+        """
+        assert threads > 0, "Stage {} has no threads".format(name)
+        self.stages[name] = (func, threads)
+
+    def run(self, items):
+        """Runs every item in 'items' through the stages.
+
+        Items are passed to the first stage by a separate thread, so
+        'items' may be a generator that takes time to produce them.
+        Output of the stage threads is dropped.
+
+        Args:
+            items (iterable):   items to run.
+
+        Yields:
+            each item as it leaves the pipeline, in the order they finish.
+
+        Raises:
+            Exception: any exception raised by a stage or by 'items'.
+        """
+        queues = {name: queue.Queue(QUEUE_SIZE) for name in self.stages}
+        finished = queue.Queue()
+        first = next(iter(self.stages))
+
+        original_stdout, original_stderr = sys.stdout, sys.stderr
+        sys.stdout = QuietOutput(original_stdout)
+        sys.stderr = QuietOutput(original_stderr)
+
+        threads = [threading.Thread(
+            target=self._feed, args=(items, queues[first], finished),
+            daemon=True)]
+        for name, (func, num) in self.stages.items():
+            for i in range(num):
+                threads.append(threading.Thread(
+                    target=self._work, args=(func, name, queues, finished),
+                    daemon=True))
+
+        for t in threads:
+            t.start()
+
+        try:
+            fed = None
+            done = 0
+            while fed is None or done < fed:
+                kind, value = finished.get()
+                if kind == 'error':
+                    raise value
+                elif kind == 'fed':
+                    fed = value
+                else:
+                    done += 1
+                    yield value
+
+            # All queues are empty, stop the threads.
+            for name, (func, num) in self.stages.items():
+                for i in range(num):
+                    queues[name].put(None)
+        finally:
+            # Threads left waiting if a stage failed are daemons, so they
+            # don't keep the program running.
+            sys.stdout, sys.stderr = original_stdout, original_stderr
+
+    def _feed(self, items, first, finished):
+        """Passes items to the first stage, then reports how many there are."""
+        count = 0
+        try:
+            for item in items:
+                first.put(item)
+                count += 1
+        except Exception as e:
+            finished.put(('error', e))
+        else:
+            finished.put(('fed', count))
+
+    def _work(self, func, name, queues, finished):
+        """Runs 'func' on items of stage 'name' until None is received."""
+        _thread_state.quiet = True
+        while True:
+            item = queues[name].get()
+            if item is None:
+                break
+
+            try:
+                next_stage, item = func(item)
+            except Exception as e:
+                finished.put(('error', e))
+                break
+
+            if next_stage is None:
+                finished.put(('done', item))
+            else:
+                queues[next_stage].put(item)
@@ -0,0 +1,131 @@
+"""Implements the Report class, a record of how each song was processed.
+
+Written by Clysop.
+"""
+
+import json
+import heapq
+
+import timing
+from song import USED_AUDIO
+
+# Number of slowest songs listed in the summary.
+SLOWEST = 10
+
+
+class Report():
+    """Class for writing a line of JSON for every processed song.
+
+    Each line holds the path and result of a song, the size of its audio,
+    its volume and gain, and the seconds spent on each step of processing
+    it. Totals are kept, so a summary of where time went can be written
+    at the end.
+
+    Attributes:
+        filename (str):         path of the JSON lines file.
+        summary_filename (str): path of the summary JSON file.
+        results (dict):         number of songs of each result.
+        stages (dict):          total seconds of each step.
+        seconds (float):        total seconds of all songs.
+        audio_size (int):       total size of audio of all songs in bytes.
+        slowest (list):         (seconds, path) of the slowest songs.
+    """
+
+    def __init__(self, filename, summary_filename):
+        self.filename = filename
+        self.summary_filename = summary_filename
+
+        self.results = {}
+        self.stages = {}
+        self.seconds = 0.0
+        self.audio_size = 0
+        self.slowest = []
+
+        self._file = open(filename, 'w')
+
+    def add(self, path, result, seconds, timings, cache_data):
+        """Writes a line for a processed song.
+
+        Args:
+            path (str):         path of song.
+            result (str):       what was done with the song.
+            seconds (float):    time it took to process the song.
+            timings (dict):     seconds of each step, see Song.timings.
+            cache_data (dict):  cache data of song, see Song.cache_data.
+        """
+        audio_size = sum(stat[0] for name, stat in
+                         cache_data.get('sources', {}).items()
+                         if name in USED_AUDIO)
+
+        line = {
+            'path': path,
+            'result': result,
+            'seconds': round(seconds, 3),
+            'stages': {k: round(v, 3) for k, v in timings.items()},
+            'audio_size': audio_size,
+            'volume': cache_data.get('volume'),
+            'gain': cache_data.get('gain'),
+        }
+        self._file.write(json.dumps(line) + '\n')
+        self._file.flush()
+
+        self.results[result] = self.results.get(result, 0) + 1
+        for stage, stage_seconds in timings.items():
+            timing.add(self.stages, stage, stage_seconds)
+        self.seconds += seconds
+        self.audio_size += audio_size
+
+        heapq.heappush(self.slowest, (seconds, path))
+        if len(self.slowest) > SLOWEST:
+            heapq.heappop(self.slowest)
+
+    def summary(self):
+        """Returns totals of all songs written so far.
+
+        Returns:
+            dict: number of songs of each result, total seconds and share
+                of each step, and the slowest songs.
+        """
+        total = sum(self.stages.values()) or 1
+        stages = {}
+        for stage in timing.STAGES:
+            if stage in self.stages:
+                stages[stage] = {
+                    'seconds': round(self.stages[stage], 3),
+                    'share': round(self.stages[stage] / total, 3),
+                }
+
+        return {
+            'songs': sum(self.results.values()),
+            'results': self.results,
+            'seconds': round(self.seconds, 3),
+            'audio_size': self.audio_size,
+            'stages': stages,
+            'slowest': [{'path': p, 'seconds': round(s, 3)}
+                        for s, p in sorted(self.slowest, reverse=True)],
+        }
+
+    def write_summary(self):
+        """Writes the summary to self.summary_filename."""
+        with open(self.summary_filename, 'w') as f:
+            json.dump(self.summary(), f, indent=2)
+
+    def print_summary(self, slowest=5):
+        """Prints time of each step, and the 'slowest' slowest songs."""
+        summary = self.summary()
+        if summary['songs'] == 0:
+            return
+
+        print("  Time per step, summed over songs:")
+        for stage, values in summary['stages'].items():
+            print("    {:<8} {:>9.1f} s {:>4.0f}%".format(
+                stage, values['seconds'], values['share'] * 100))
+
+        print("\n  Slowest songs:")
+        for song in summary['slowest'][:slowest]:
+            print("    {:>7.1f} s  {}".format(song['seconds'], song['path']))
+        print()
+
+    def close(self):
+        """Closes the report file."""
+        self._file.close()
@@ -0,0 +1,196 @@
+"""Runs songs in a process pool or threads, keeping memory within a budget.
+
+Written by Clysop.
+"""
+
+import os
+import queue
+import threading
+
+import headers
+from audio import IMPORT_WIDTH
+
+try:
+    import mixer
+except ImportError:
+    # NumPy is not installed, songs are mixed whole with audioop.
+    mixer = None
+
+# Bytes per sample of decoded audio, see IMPORT_WIDTH.
+SAMPLE_SIZE = IMPORT_WIDTH // 8
+# Bytes per sample of the mix of all stems, which is summed as int32.
+MIX_SAMPLE_SIZE = 4
+# Decoded size of audiofiles whose headers can't be read, relative to their
+# file size. 1411 kbit/s of CD quality audio over a common 128 kbit/s.
+SIZE_RATIO = 11
+# Memory used by a process that doesn't hold a whole song, like when
+# streaming, or exporting from the original audiofiles.
+BASE_MEMORY = 64 * 2 ** 20
+
+
+def estimate_memory(song):
+    """Estimates how much memory a song needs to be loaded and mixed.
+
+    Decoded audio takes duration * sample rate * channels * SAMPLE_SIZE
+    bytes per stem, read from the headers of the audiofiles. Files that
+    can't be parsed are estimated from their size instead. The stereo mix
+    of all stems is added on top, only a block of it when mixed with
+    NumPy, see mixer.mix_blocks.
+
+    Headers that are read are stored in the Audio objects, so they aren't
+    probed again when the song is processed, see normalizer.Task.
+
+    Args:
+        song (Song):    song whose files have been scanned.
+
+    Returns:
+        int: estimated peak memory in bytes.
+    """
+    total = 0
+    longest = 0
+    for a in song.files:
+        info = a.info or headers.read_info(os.path.join(song.path, a.filename))
+        if info and 'duration' in info:
+            a.info = info
+            frames = float(info['duration']) * int(info['sample_rate'])
+            total += frames * info['channels'] * SAMPLE_SIZE
+        else:
+            size = song.sources[a.filename][0] * SIZE_RATIO
+            frames = size / SAMPLE_SIZE / 2
+            total += size
+
+        longest = max(longest, frames)
+
+    if mixer is not None:
+        longest = min(longest, mixer.BLOCK_FRAMES)
+
+    return BASE_MEMORY + int(total + longest * 2 * MIX_SAMPLE_SIZE)
+
+
+def loaded_memory(song):
+    """Returns memory held by the loaded audio of 'song', in bytes.
+
+    Audio spilled to disk isn't counted. BASE_MEMORY is added, like in
+    estimate_memory.
+    """
+    return BASE_MEMORY + sum(len(a.data) for a in song.files
+                             if a.data is not None and a.spill_file is None)
+
+
+class Scheduler():
+    """Class for passing tasks to a process pool within a memory budget.
+
+    Tasks are only started while the estimated memory of all running tasks
+    stays within the budget, and while there are free processes. Tasks
+    bigger than the whole budget are run alone.
+
+    Attributes:
+        budget (int):       max estimated memory of running tasks, in bytes.
+        processes (int):    max number of tasks running at a time.
+    """
+
+    def __init__(self, budget, processes):
+        assert budget > 0, "Memory budget must be positive"
+        assert processes > 0, "Number of processes must be positive"
+
+        self.budget = budget
+        self.processes = processes
+
+    def run(self, pool, func, tasks):
+        """Runs 'func' on every task in 'pool', as memory allows.
+
+        Tasks are started in the order they come in, a task waits for
+        enough running tasks to finish instead of being passed over.
+
+        Args:
+            pool (multiprocessing.Pool):    pool to run tasks in.
+            func (callable):    function run on each task.
+            tasks (iterable):   (task, memory) tuples, 'memory' being the
+                                estimated memory of 'task' in bytes.
+
+        Yields:
+            return value of 'func' of each task, in the order they finish.
+        """
+        finished = queue.Queue()
+        running = 0
+        in_use = 0
+
+        for task, memory in tasks:
+            memory = min(memory, self.budget)
+
+            # Wait for room in the budget, unless nothing else is running.
+            while running > 0 and (running >= self.processes or
+                                   in_use + memory > self.budget):
+                result, done_memory = self._wait(finished)
+                running -= 1
+                in_use -= done_memory
+                yield result
+
+            pool.apply_async(
+                func, (task,),
+                callback=lambda r, m=memory: finished.put((r, m, None)),
+                error_callback=lambda e, m=memory: finished.put((None, m, e))
+            )
+            running += 1
+            in_use += memory
+
+        while running > 0:
+            result, done_memory = self._wait(finished)
+            running -= 1
+            yield result
+
+    def _wait(self, finished):
+        """Waits for a task to finish.
+
+        Returns:
+            tuple: return value of the task and its estimated memory.
+
+        Raises:
+            Exception: any exception the pool couldn't pass back as a result.
+        """
+        result, memory, error = finished.get()
+        if error is not None:
+            raise error
+        return result, memory
+
+
+class MemoryBudget():
+    """Class for keeping memory of songs held by threads within a budget.
+
+    Like Scheduler, but threads take memory themselves, waiting until it
+    fits in the budget, and give it back once the song's audio is freed.
+    Songs bigger than the whole budget wait until no other song holds
+    memory.
+
+    Attributes:
+        budget (int):   max estimated memory held at a time, in bytes.
+        in_use (int):   estimated memory held now, in bytes.
+    """
+
+    def __init__(self, budget):
+        assert budget > 0, "Memory budget must be positive"
+
+        self.budget = budget
+        self.in_use = 0
+        self._condition = threading.Condition()
+
+    def acquire(self, memory):
+        """Waits until 'memory' bytes fit in the budget, then takes them.
+
+        Returns:
+            int: bytes taken, to be passed to release.
+        """
+        memory = min(memory, self.budget)
+        with self._condition:
+            self._condition.wait_for(
+                lambda: self.in_use == 0 or
+                self.in_use + memory <= self.budget)
+            self.in_use += memory
+
+        return memory
+
+    def release(self, memory):
+        """Gives back 'memory' bytes taken by acquire."""
+        with self._condition:
+            self.in_use -= memory
+            self._condition.notify_all()
@@ -0,0 +1,66 @@
+"""Splits a library into shards that can be processed on separate machines.
+
+Every song belongs to one of N shards, decided by a hash of its path
+relative to the library, so every machine finds the same split without
+talking to the others. Each shard writes its own cache fragment, which
+are merged into the main cache afterwards.
+
+Written by Clysop.
+"""
+
+import os
+import glob
+import hashlib
+
+
+def parse_shard(text):
+    """Parses a shard given as 'i/N', i being from 1 to N.
+
+    Returns:
+        tuple: index of shard from 1, and number of shards.
+
+    Raises:
+        ValueError: if 'text' isn't a valid shard.
+    """
+    index, _, count = text.partition('/')
+    index, count = int(index), int(count)
+    if not 1 <= index <= count:
+        raise ValueError("Shard must be between 1/N and N/N")
+
+    return index, count
+
+
+def shard_of(path, count):
+    """Returns the shard from 1 to 'count' that 'path' belongs to.
+
+    Python's hash is salted for every process, so MD5 is used instead.
+    Paths use the separators of the operating system, like the keys of
+    the cache, so only machines running the same one agree.
+
+    Args:
+        path (str):     path of song relative to the library.
+        count (int):    number of shards.
+    """
+    digest = hashlib.md5(path.encode('utf-8')).digest()
+    return int.from_bytes(digest[:8], 'big') % count + 1
+
+
+def shard_filename(filename, shard):
+    """Returns the name of the file of 'shard' used instead of 'filename'.
+
+    Args:
+        filename (str): name of file written by a whole run.
+        shard (tuple):  index and number of shards, see parse_shard. If
+                        None, 'filename' is returned.
+    """
+    if shard is None:
+        return filename
+
+    root, extension = os.path.splitext(filename)
+    return '{}.shard-{}-of-{}{}'.format(root, shard[0], shard[1], extension)
+
+
+def find_fragments(filename):
+    """Returns the files of every shard found for 'filename', sorted."""
+    pattern = shard_filename(glob.escape(filename), ('*', '*'))
+    return sorted(glob.glob(pattern))
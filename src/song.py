@@ -4,12 +4,34 @@ Written by Clysop.
 """
 
 import os
+import re
 import math
-import time
-import shutil
-import audioop
-
-from audio import Audio, IMPORT_WIDTH
+import hashlib
+import subprocess
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+import ffmpy
+
+import timing
+import linking
+import mp3gain
+from audio import Audio, IMPORT_WIDTH, BLOCK_SIZE, FFMPEG_PATH, export_batch
+
+try:
+    import mixer
+    import loudness
+except ImportError:
+    # NumPy is not installed, mix with audioop instead. R128 loudness can
+    # only be measured by FFmpeg.
+    mixer = None
+    loudness = None
+
+try:
+    import audioop
+except ImportError:
+    # Removed in Python 3.13, NumPy is needed there.
+    audioop = None
 
 # List of filenames used as audio by Clone Hero.
 USED_AUDIO = ['crowd', 'song', 'guitar', 'drums', 'drums_1', 'drums_2',
@@ -22,22 +44,66 @@ for f in USED_AUDIO:
     used_audio.append(f + '.mp3')
 USED_AUDIO = used_audio
 
+# Filenames of charts, one of which is in every song folder.
+CHART_FILES = ['notes.chart', 'notes.mid']
+
+# Number of bytes hashed from each end of a file when fingerprinting it.
+FINGERPRINT_SIZE = 2 ** 16
+
+# Number of standard errors the volume of a sampled song may be off by.
+# A bit wider than 2, as there are few windows.
+SAMPLED_ERROR_BOUND = 2.5
+
+# Finds the volume in output from FFmpeg's volumedetect filter.
+MEAN_VOLUME = re.compile(r'mean_volume: (-?\d+(?:\.\d+)?|-inf) dB')
+# Finds the integrated loudness in output from FFmpeg's ebur128 filter.
+INTEGRATED = re.compile(r'I:\s+(-?\d+(?:\.\d+)?|-inf) LUFS')
+
 
-def list_files(path, used=True):
-    """List files in path the are in USED_AUDIO
+def scan(path):
+    """Reads size and modification time of every file in 'path'.
+
+    Uses a single os.scandir, which on Windows gets the stats of all
+    files without opening any of them.
 
     Args:
-        path (str):     path to search in.
-        used (bool):    True to list files in USED_AUDIO,
-                        False to list other files.
+        path (str): path to scan.
+
+    Returns:
+        dict: [size, modification time in ns] of each file, by filename.
+            Empty if 'path' doesn't exist.
+    """
+    files = {}
+
+    try:
+        with os.scandir(path) as entries:
+            for entry in entries:
+                if entry.is_file():
+                    stat = entry.stat()
+                    files[entry.name] = [stat.st_size, stat.st_mtime_ns]
+    except FileNotFoundError:
+        pass
+
+    return files
 
-    Yields:
-        str: filename
+
+def fingerprint(filepath):
+    """Returns a hash of the size and first and last FINGERPRINT_SIZE bytes.
+
+    Much faster than hashing the whole file, but still changes when the
+    file is replaced by different audio.
     """
-    for filename in os.listdir(path):
-        file_exists = os.path.isfile(os.path.join(path, filename))
-        if file_exists and (filename in USED_AUDIO) == used:
-            yield filename
+    digest = hashlib.blake2b(digest_size=16)
+
+    with open(filepath, 'rb') as f:
+        size = os.fstat(f.fileno()).st_size
+        digest.update(str(size).encode())
+        digest.update(f.read(FINGERPRINT_SIZE))
+        if size > FINGERPRINT_SIZE:
+            f.seek(max(FINGERPRINT_SIZE, size - FINGERPRINT_SIZE))
+            digest.update(f.read())
+
+    return digest.hexdigest()
 
 
 class Song():
@@ -46,67 +112,216 @@ class Song():
     Attributes:
         path (str):         song folders path.
         files (list):       list of Audio objects that contain loaded audio.
-        cache_data (dict):  stores timestamps for loaded audiofiles.
-                            Gets rewritten when copying or exporting audio.
+        sources (dict):     [size, modification time in ns] of each file
+                            in self.path, by filename.
+        cache_data (dict):  stores the state of self.path and of the
+                            files output from it, see make_cache_data.
+        timings (dict):     seconds spent on each step of processing, by
+                            name, see timing.STAGES.
     """
 
-    def __init__(self, path):
+    def __init__(self, path, sources=None):
+        """Args:
+            path (str):     song folders path.
+            sources (dict): stats of files in 'path' if already scanned,
+                            see scan. Used by scan_files instead of
+                            scanning again.
+        """
         assert type(path) is str, "{} is not a string".format(path)
-        assert os.path.isdir(path), "{} is not a directory".format(path)
 
-        assert os.path.isfile('{}/notes.mid'.format(path)) \
-            or os.path.isfile('{}/notes.chart'.format(path)), \
-            "Chart file not found in {}".format(path)
+        if sources is None:
+            assert os.path.isdir(path), "{} is not a directory".format(path)
+            files = [f for f in CHART_FILES
+                     if os.path.isfile(os.path.join(path, f))]
+        else:
+            files = [f for f in CHART_FILES if f in sources]
+        assert len(files) > 0, "Chart file not found in {}".format(path)
 
         self.path = path
         self.files = []
+        self.sources = sources or {}
         self.cache_data = {}
+        self.timings = {}
+
+    def check_cache(self, data, path=None, fingerprints=False):
+        """Checks if given cache data matches the files of the song.
+
+        The song is unchanged if the files in self.path have the same sizes
+        and modification times as when it was cached, and all files that
+        were output to 'path' are still there, unchanged. No audio is
+        opened to find this out. With 'fingerprints', files with changed
+        modification times are fingerprinted to find out if they really
+        changed.
 
-    def check_cache(self, data):
-        """Checks if given cache data is newer than self's data.
+        Cache data from older versions only has timestamps of audiofiles,
+        which should be newer than the audiofiles' modification times.
 
         Args:
-            data (dict): timestamp data for files in self.path
+            data (dict):            cache data of song, see make_cache_data.
+            path (str):             path files were output to, if any.
+            fingerprints (bool):    whether to compare fingerprints.
 
         Returns:
-            bool: True if data is newer than self.cache_data, False otherwise.
+            bool: True if nothing has changed, False otherwise.
         """
-        for filename in self.cache_data:
-            if filename not in data or \
-                    self.cache_data[filename] > data[filename]:
-                return False
+        if 'sources' not in data:
+            for a in self.files:
+                mtime = self.sources[a.filename][1] // 10 ** 9
+                if a.filename not in data or mtime > data[a.filename]:
+                    return False
+            return True
+
+        if not self._check_sources(data['sources'], fingerprints):
+            return False
+
+        if path is not None and len(data.get('outputs', {})) > 0:
+            outputs = scan(path)
+            for filename, stat in data['outputs'].items():
+                if outputs.get(filename) != stat:
+                    return False
 
         return True
 
+    def cached_volume(self, data, measure, fingerprints=False):
+        """Returns the volume stored in given cache data, if still valid.
+
+        The volume is valid if it was measured with 'measure' and the files
+        in self.path haven't changed since, see check_cache.
+
+        Args:
+            data (dict):            cache data of song, see make_cache_data.
+            measure (str):          how the volume should have been measured.
+            fingerprints (bool):    whether to compare fingerprints.
+
+        Returns:
+            float: volume in dBFS, None if there is no valid volume.
+        """
+        if data.get('volume') is None or data.get('measure') != measure:
+            return None
+
+        if not self._check_sources(data['sources'], fingerprints):
+            return None
+
+        return data['volume']
+
+    def _check_sources(self, cached, fingerprints):
+        """Checks if cached stats of files in self.path match self.sources."""
+        if cached.keys() != self.sources.keys():
+            return False
+
+        for filename, stat in self.sources.items():
+            if cached[filename][:2] == stat:
+                continue
+
+            # Same content if touched or copied, which changes the time.
+            if fingerprints and len(cached[filename]) > 2 and \
+                    cached[filename][0] == stat[0] and \
+                    cached[filename][2] == fingerprint(
+                        os.path.join(self.path, filename)):
+                continue
+
+            return False
+
+        return True
+
+    def make_cache_data(self, path=None, fingerprints=False):
+        """Fills self.cache_data with the state of the song's files.
+
+        Stores self.sources and, if 'path' is given, the sizes and
+        modification times of the files output to 'path'.
+
+        Args:
+            path (str):             path files were output to, if any.
+            fingerprints (bool):    whether to store fingerprints of sources.
+        """
+        sources = {}
+        for filename, stat in self.sources.items():
+            if fingerprints:
+                stat = stat + [fingerprint(os.path.join(self.path, filename))]
+            sources[filename] = stat
+
+        self.cache_data = {'sources': sources}
+        if path is not None:
+            self.cache_data['outputs'] = scan(path)
+
     def scan_files(self):
-        """Finds all audiofiles in USED_AUDIO in self.path.
+        """Finds all files in self.path.
 
-        Fills self.files with Audio objects representing each audiofile in
-        self.path.
-        Also fills self.cache_data with time of creation for each file.
+        Fills self.sources with the stats of every file in self.path, if
+        not already filled, and self.files with Audio objects representing
+        each audiofile in USED_AUDIO.
         """
-        for filename in list_files(self.path):
-            a = Audio(filename)
-            self.files.append(a)
+        if len(self.sources) == 0:
+            self.sources = scan(self.path)
+        self.files = [Audio(f) for f in self.sources if f in USED_AUDIO]
+        self.make_cache_data()
+
+    def audio_size(self):
+        """Returns total size in bytes of audiofiles in self.sources."""
+        return sum(stat[0] for filename, stat in self.sources.items()
+                   if filename in USED_AUDIO)
+
+    @timing.timed('probe')
+    def probe_files(self, indent=0, decoder=None):
+        """Probes audio in Audio objects in self.files, without loading it.
+
+        Audio objects that have already been probed are not probed again.
 
-            self.cache_data[filename] = int(os.path.getmtime(
-                os.path.join(self.path, filename)))
+        Args:
+            indent (int):       indentation used when printing info
+            decoder (object):   decoder to probe with, see Audio.probe.
+
+        Returns:
+            bool: True if any audio was probed, False otherwise.
+        """
+        for a in self.files.copy():
+            print(' ' * indent + "Probing {}...".format(a.filename))
+            if not (a.info or a.probe(self.path, decoder)):
+                print(' ' * indent * 2 + 'Error, skipping')
+                self.files.remove(a)
 
-    def load_files(self, indent=0, debug=False):
+        # Check if any audio got probed successfully.
+        if len(self.files) > 0:
+            return True
+        else:
+            return False
+
+    @timing.timed('decode')
+    def load_files(self, indent=0, debug=False, threads=1, sample_rate=None,
+                   decoder=None, spill=None):
         """Loads audio in Audio objects in self.files.
 
+        Audio objects that have already been probed are not probed again.
+        Each audiofile is decoded by its own FFmpeg process, 'threads' of
+        them at a time. Audio loaded at another 'sample_rate' than its own
+        can be analyzed, but should be unloaded before exporting.
+
         Args:
-            indent (int):   indentation used when printing info
-            debug (bool):   whether FFmpeg should output info when loading.
+            indent (int):       indentation used when printing info
+            debug (bool):       whether FFmpeg should output info when loading.
+            threads (int):      max number of audiofiles loaded at a time.
+            sample_rate (int):  sample rate to load at, native if None.
+            decoder (object):   decoder to load with, see Audio.load.
+            spill (str):        folder to spill audio to instead of holding
+                                it in memory, see Audio.spill. FFmpeg
+                                decodes spilled audio, not 'decoder'.
 
         Returns:
             bool: True if any audio was loaded, False otherwise.
         """
-        for a in self.files.copy():
+        for a in self.files:
             print(' ' * indent + "Loading {}...".format(a.filename))
-            probe = a.probe(self.path)
-            if not (probe and a.load(self.path, debug=debug)):
-                print(' ' * indent * 2 + 'Error, skipping')
+
+        with ThreadPoolExecutor(threads) as executor:
+            loaded = list(executor.map(
+                lambda a: self._load_audio(a, debug, sample_rate, decoder,
+                                           spill),
+                self.files))
+
+        for a, success in zip(self.files.copy(), loaded):
+            if not success:
+                print(' ' * indent * 2 + 'Error loading {}, skipping'.format(
+                    a.filename))
                 self.files.remove(a)
 
         # Check if any audio got loaded successfully.
@@ -115,6 +330,49 @@ class Song():
         else:
             return False
 
+    def _load_audio(self, a, debug=False, sample_rate=None, decoder=None,
+                    spill=None):
+        """Probes, if needed, and loads or spills Audio object 'a'.
+
+        Returns:
+            bool: True if successful, False otherwise.
+        """
+        if not (a.info or a.probe(self.path, decoder)):
+            return False
+        elif spill is not None:
+            return a.spill(self.path, spill, debug, sample_rate)
+        else:
+            return a.load(self.path, debug, sample_rate, decoder)
+
+    def unload_files(self):
+        """Frees loaded audio in self.files, keeping probed info.
+
+        Removes files audio was spilled to. Audio is then exported by
+        decoding the audiofiles again.
+        """
+        for a in self.files:
+            a.unload()
+
+    def unload_unpiped(self):
+        """Frees loaded audio in self.files, except audio that is piped.
+
+        Only one loaded audio is piped when the audiofiles are exported by
+        a single FFmpeg process, the rest is decoded again from self.path,
+        see _encode. Their audio is freed once analyzed instead of being
+        held until the song is copied. Spilled audio is kept.
+        """
+        piped = False
+        for a in self.files:
+            if a.data is None or a.spill_file is not None:
+                continue
+            if piped:
+                a.unload()
+            piped = True
+
+    def _stems(self):
+        """Returns (data, channels) tuples of loaded audio in self.files."""
+        return [(a.data, a.info.get('channels', 2)) for a in self.files]
+
     def _combine_audio(self):
         """Combines all audio in self.files into one song of raw audio."""
         if len(self.files) == 0:
@@ -122,6 +380,10 @@ class Song():
         elif len(self.files) == 1:
             return self.files[0].data
 
+        if mixer is not None:
+            combined = mixer.mix(self._stems())
+            return combined.astype(mixer.SAMPLE_TYPE).tobytes()
+
         # Find length of longest audiofile.
         longest = 0
         for file in self.files:
@@ -146,75 +408,445 @@ class Song():
 
         return combined
 
-    def get_volume(self):
-        """Returns volume of song in dBFS.
+    @timing.timed('mix')
+    def get_volume(self, measure='rms', sample_rate=None):
+        """Returns volume of song.
+
+        Args:
+            measure (str):      'rms' for RMS in dBFS, 'r128' for integrated
+                                loudness in LUFS, which needs NumPy.
+            sample_rate (int):  sample rate audio was loaded at, if not its
+                                own, see load_files.
 
         Returns:
-            float: volume in dBFS.
+            float: volume in dBFS or LUFS.
         """
+        if measure == 'r128':
+            meter = self._meter(sample_rate)
+            for block in mixer.mix_blocks(self._stems()):
+                meter.add(block)
+            return meter.integrated()
+
+        if mixer is not None:
+            if len(self.files) == 1:
+                # Nothing to mix, analyze the loaded audio directly.
+                samples = mixer.to_samples(*self._stems()[0])
+                return self._to_dbfs(mixer.rms(samples))
+
+            # Mix in blocks, so the whole mix isn't held in memory.
+            total = count = 0
+            for block in mixer.mix_blocks(self._stems()):
+                total += mixer.sum_squares(block)
+                count += block.size
+            return self._to_dbfs(math.sqrt(total / count) if count else 0.0)
+
         data = self._combine_audio()
         rms = audioop.rms(data, int(IMPORT_WIDTH / 8))
 
+        return self._to_dbfs(rms)
+
+    @timing.timed('analyze')
+    def get_volume_stream(self, block_size=BLOCK_SIZE, indent=0, debug=False,
+                          sample_rate=None, measure='rms'):
+        """Returns volume of song, streaming audio instead of loading.
+
+        Mixes audio block by block and keeps a running sum of squares, or
+        feeds a loudness meter, so memory use is bounded by 'block_size'
+        instead of the song's length.
+        Uses info in the Audio objects, so files should be probed first.
+        Audiofiles that can't be streamed are removed from self.files.
+
+        Args:
+            block_size (int):   max number of bytes mixed at a time.
+            indent (int):       indentation used when printing info.
+            debug (bool):       whether FFmpeg should output info when loading.
+            sample_rate (int):  sample rate to decode at, native if None.
+            measure (str):      how volume is measured, see get_volume.
+
+        Returns:
+            float: volume in dBFS or LUFS, None if no audio could be
+                streamed.
+        """
+        while len(self.files) > 0:
+            streams = []
+            for a in self.files:
+                channels = a.info.get('channels', 2)
+                # Mono blocks are doubled when converted to stereo.
+                size = block_size // 2 if channels == 1 else block_size
+                streams.append((a, channels, a.stream(self.path, size, debug,
+                                                      sample_rate)))
+
+            failed = []
+            squares = 0
+            samples = 0
+            meter = self._meter(sample_rate) if measure == 'r128' else None
+            active = streams.copy()
+            while len(active) > 0 and len(failed) == 0:
+                blocks = []
+                for s in active.copy():
+                    a, channels, stream = s
+                    try:
+                        blocks.append((next(stream), channels))
+                    except StopIteration:
+                        active.remove(s)
+                    except ffmpy.FFRuntimeError:
+                        failed.append(a)
+                        active.remove(s)
+
+                if len(blocks) > 0 and meter is not None:
+                    meter.add(mixer.mix(blocks))
+                elif len(blocks) > 0:
+                    block_squares, block_samples = self._sum_squares(blocks)
+                    squares += block_squares
+                    samples += block_samples
+
+            for a, channels, stream in streams:
+                stream.close()
+
+            if len(failed) == 0:
+                if meter is not None:
+                    return meter.integrated()
+                if samples == 0:
+                    return -math.inf
+                return self._to_dbfs(math.sqrt(squares / samples))
+
+            # Start over without the audiofiles that failed.
+            for a in failed:
+                print(' ' * indent + "Error streaming {}, skipping".format(
+                    a.filename))
+                self.files.remove(a)
+
+        return None
+
+    @timing.timed('analyze')
+    def get_volume_sampled(self, windows, length, threads=1, debug=False,
+                           sample_rate=None, measure='rms'):
+        """Estimates volume of song from evenly spaced windows.
+
+        Decodes 'windows' windows of 'length' seconds, at the same places
+        in every audiofile, mixes each window and measures its power. The
+        volume is estimated from the mean power of the windows, or from
+        the gating blocks of all windows for R128 loudness, and their
+        spread gives a bound on how far off the estimate may be. Uses the
+        durations in the Audio objects, so files should be probed first.
+
+        Args:
+            windows (int):      number of windows, at least 2.
+            length (float):     length of each window in seconds.
+            threads (int):      max number of windows decoded at a time.
+            debug (bool):       whether FFmpeg should output info.
+            sample_rate (int):  sample rate to decode at, native if None.
+            measure (str):      how volume is measured, see get_volume.
+
+        Returns:
+            tuple: estimated volume, and lowest and highest likely volume,
+                in dBFS or LUFS. None if the song is too short to sample,
+                or its durations aren't known or audio couldn't be decoded.
+        """
+        assert windows >= 2, "At least 2 windows are needed"
+
+        try:
+            duration = max(float(a.info['duration']) for a in self.files)
+        except (KeyError, ValueError):
+            return None
+
+        # Sampling most of a song is no faster than decoding all of it.
+        if windows * length * 2 > duration:
+            return None
+
+        # Windows are centered in equal parts of the song.
+        starts = [(i + 0.5) * duration / windows - length / 2
+                  for i in range(windows)]
+        jobs = [(a, start) for start in starts for a in self.files]
+
+        with ThreadPoolExecutor(threads) as executor:
+            decoded = list(executor.map(
+                lambda job: job[0].load_window(self.path, job[1], length,
+                                               debug, sample_rate), jobs))
+        if any(data is None for data in decoded):
+            return None
+
+        powers = []
+        blocks = []
+        for i in range(windows):
+            stems = [(data, a.info.get('channels', 2)) for (a, start), data
+                     in zip(jobs, decoded) if start == starts[i]]
+            if measure == 'r128':
+                meter = self._meter(sample_rate)
+                meter.add(mixer.mix(stems))
+                window_blocks = meter.block_powers()
+                if len(window_blocks) > 0:
+                    powers.append(window_blocks.mean())
+                    blocks.extend(window_blocks)
+            else:
+                squares, samples = self._sum_squares(stems)
+                if samples > 0:
+                    powers.append(squares / samples)
+
+        if len(powers) < 2:
+            return None
+
+        mean = sum(powers) / len(powers)
+        if mean == 0:
+            return None
+        variance = sum((p - mean) ** 2 for p in powers) / (len(powers) - 1)
+        # Windows cover part of the song, so they vary less than a sample
+        # of a bigger population would.
+        coverage = min(1.0, len(powers) * length / duration)
+        error = SAMPLED_ERROR_BOUND * math.sqrt(
+            variance / len(powers) * (1 - coverage))
+
+        if measure == 'r128':
+            volume = loudness.gate(blocks)
+        else:
+            volume = self._to_dbfs(math.sqrt(mean))
+
+        if mean > error:
+            low = volume + 10 * math.log10((mean - error) / mean)
+        else:
+            low = -math.inf
+        high = volume + 10 * math.log10((mean + error) / mean)
+
+        return volume, low, high
+
+    @timing.timed('analyze')
+    def get_volume_ffmpeg(self, debug=False, measure='rms'):
+        """Returns volume of song, mixed and measured by FFmpeg.
+
+        Runs a single FFmpeg process with all audiofiles as inputs, which
+        mixes them and measures the volume with the volumedetect filter,
+        or the ebur128 filter for R128 loudness. No raw audio is passed to
+        Python, only the measured volume, which has a precision of 0.1 dB.
+        Uses info in the Audio objects, so files should be probed first.
+
+        Args:
+            debug (bool):   whether FFmpeg's output should be printed.
+            measure (str):  how volume is measured, see get_volume.
+
+        Returns:
+            float: volume in dBFS or LUFS, None if FFmpeg failed.
+        """
+        if measure == 'r128':
+            # Loudness of every 100 ms is only logged in verbose mode.
+            analyzer, result = 'ebur128=framelog=verbose', INTEGRATED
+        else:
+            analyzer, result = 'volumedetect', MEAN_VOLUME
+
+        inputs = OrderedDict()
+        graph = []
+        for i, a in enumerate(self.files):
+            inputs[os.path.join(self.path, a.filename)] = ''
+
+            # Mix as stereo, mono is copied to both channels.
+            if a.info.get('channels', 2) == 1:
+                graph.append('[{0}:a]pan=stereo|c0=c0|c1=c0[a{0}]'.format(i))
+            else:
+                graph.append(
+                    '[{0}:a]aformat=channel_layouts=stereo[a{0}]'.format(i))
+
+        labels = ''.join('[a{}]'.format(i) for i in range(len(self.files)))
+        if len(self.files) > 1:
+            graph.append('{}amix=inputs={}:duration=longest:normalize=0,'
+                         '{}'.format(labels, len(self.files), analyzer))
+        else:
+            graph.append('{}{}'.format(labels, analyzer))
+
+        ff = ffmpy.FFmpeg(
+            executable=FFMPEG_PATH,
+            global_options='-y -hide_banner -nostats',
+            inputs=inputs,
+            outputs={'-': ['-filter_complex', ';'.join(graph), '-f', 'null']}
+        )
+
+        try:
+            out, err = ff.run(stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        except ffmpy.FFRuntimeError:
+            return None
+
+        err = err.decode(errors='replace')
+        if debug:
+            print(err)
+
+        matches = result.findall(err)
+        if len(matches) == 0:
+            return None
+
+        return float(matches[-1])
+
+    def _sample_rate(self, sample_rate=None):
+        """Returns 'sample_rate', or that of the first audiofile if None."""
+        if sample_rate:
+            return sample_rate
+        return int(self.files[0].info.get('sample_rate', 44100))
+
+    def _meter(self, sample_rate=None):
+        """Returns a loudness meter for the mixed audio of the song.
+
+        Args:
+            sample_rate (int):  sample rate audio is decoded at, if not its
+                                own.
+        """
+        return loudness.Meter(self._sample_rate(sample_rate))
+
+    def _sum_squares(self, stems):
+        """Mixes raw audio and returns its sum of squares and sample count.
+
+        Args:
+            stems (list): (data, channels) tuples, 'data' being raw audio.
+
+        Returns:
+            tuple: sum of squares and number of samples of the stereo mix.
+        """
+        if mixer is not None:
+            mixed = mixer.mix(stems)
+            return mixer.sum_squares(mixed), mixed.size
+
+        width = int(IMPORT_WIDTH / 8)
+        blocks = []
+        for data, channels in stems:
+            # Convert to stereo if mono.
+            if channels == 1:
+                data = audioop.tostereo(data, width, 1, 1)
+            blocks.append(data)
+
+        longest = max(len(block) for block in blocks)
+        mixed = bytes(longest)
+        for block in blocks:
+            block += bytes(longest - len(block))
+            mixed = audioop.add(mixed, block, width)
+
+        count = len(mixed) // width
+        return audioop.rms(mixed, width) ** 2 * count, count
+
+    def _to_dbfs(self, rms):
+        """Converts RMS of raw audio to dBFS."""
         if rms == 0:
             return -math.inf
         else:
             rms_float = rms / (2 ** (IMPORT_WIDTH - 1) - 1)
             return 20 * math.log(rms_float, 10)
 
-    def copy(self, path, audio=True):
+    @timing.timed('copy')
+    def copy(self, path, audio=True, link_mode='copy'):
         """Copies files from self.path to 'path'.
 
         If 'audio' is True, only copies files in USED_AUDIO, otherwise
-        only copies audio not in USED_AUDIO. If copying audio, fills
-        self.cache_data with time of copying.
+        only copies files not in USED_AUDIO. Files already in 'path' are
+        only copied again if they have changed.
 
         Args:
-            path (str):     path files should be copied to.
-            audio (bool):   whether to copy files in USED_AUDIO or not.
+            path (str):         path files should be copied to.
+            audio (bool):       whether to copy files in USED_AUDIO or not.
+            link_mode (str):    how files are copied, see linking.LINK_MODES.
         """
-        cache_data = {}
-
-        for filename in list_files(self.path, audio):
-            if not os.path.isfile(os.path.join(path, filename)):
-                shutil.copy2(os.path.join(self.path, filename), path)
+        copied = scan(path)
 
-            cache_data[filename] = int(time.time())
+        for filename, stat in self.sources.items():
+            if (filename in USED_AUDIO) != audio:
+                continue
 
-        if audio:
-            self.cache_data = cache_data
+            # Copies keep their modification time, so unchanged copies
+            # have the same stats. So do links.
+            if copied.get(filename) != stat:
+                linking.link_file(os.path.join(self.path, filename),
+                                  os.path.join(path, filename), link_mode)
 
-    def export(self, path, gain, indent=0, debug=False):
+    @timing.timed('encode')
+    def export(self, path, gain, indent=0, debug=False, tolerance=None):
         """Exports audio to 'path'.
 
-        Exports audio in self.files. Fills self.cache_data with
-        time of exporting.
+        Exports audio in self.files. Audio that isn't loaded is decoded
+        again from self.path. Audiofiles are encoded by one FFmpeg process
+        where possible, see _encode.
+
+        If 'tolerance' is given and 'gain' is within 'tolerance' dB of a
+        multiple of mp3gain.GAIN_STEP, that multiple is used as gain for
+        all audiofiles instead, and MP3 files are changed losslessly
+        without being decoded.
 
         Args:
-            path (str):     path files should be exported to.
-            gain (float):   amount of gain in dB to be applied when exporting.
-            indent (int):   indentation used when printing info.
-            debug (bool):   whether FFmpeg should output info when exporting.
+            path (str):         path files should be exported to.
+            gain (float):       amount of gain in dB to be applied.
+            indent (int):       indentation used when printing info.
+            debug (bool):       whether FFmpeg should output info.
+            tolerance (float):  max dB gain may be rounded for lossless MP3.
 
         Returns:
             bool: True if successful, False otherwise.
         """
-        cache_data = {}
-
-        for a in self.files.copy():
+        # Round gain to whole steps if any MP3 files can use them.
+        steps = 0
+        has_mp3 = any(a.filename.endswith('.mp3') for a in self.files)
+        if has_mp3 and tolerance is not None:
+            steps = mp3gain.gain_steps(gain)
+            if abs(steps * mp3gain.GAIN_STEP - gain) <= tolerance:
+                gain = steps * mp3gain.GAIN_STEP
+                print(' ' * indent + "Using {:.1f} dB of gain for lossless "
+                      "MP3.".format(gain))
+            else:
+                steps = 0
+
+        encode = []
+        for a in self.files:
             print(' ' * indent + "Exporting {}...".format(a.filename))
-            if not a.export(path, gain, debug=debug):
-                print(' ' * indent * 2 + "Error, skipping")
-                self.files.remove(a)
 
-            cache_data[a.filename] = int(time.time())
+            # An earlier output may be a link to the original audiofile,
+            # so remove it instead of writing to it.
+            output = os.path.join(path, a.filename)
+            if os.path.lexists(output):
+                os.remove(output)
+
+            if steps != 0 and a.filename.endswith('.mp3'):
+                if mp3gain.apply_gain(os.path.join(self.path, a.filename),
+                                      output, steps):
+                    continue
+                print(' ' * indent * 2 + "Couldn't change MP3 losslessly, "
+                      "encoding instead")
 
-        self.cache_data = cache_data
+            encode.append(a)
+
+        for a in self._encode(encode, path, gain, indent, debug):
+            print(' ' * indent * 2 + "Error exporting {}, skipping".format(
+                a.filename))
+            a.unload()
+            self.files.remove(a)
 
         if len(self.files) > 0:
             return True
         else:
             return False
 
+    def _encode(self, files, path, gain, indent=0, debug=False):
+        """Encodes Audio objects 'files' to 'path' with 'gain' dB of gain.
+
+        All of them are encoded by a single FFmpeg process, see
+        export_batch. Only one loaded audio can be piped to it, the rest
+        of the loaded audio is decoded again from self.path by FFmpeg. If
+        it fails, they are encoded one at a time, to find which failed.
+
+        Returns:
+            list: Audio objects that couldn't be exported.
+        """
+        batch = []
+        piped = False
+        for a in files:
+            source = self.path if a.data is None else None
+            if source is None and a.spill_file is None:
+                if piped:
+                    source = self.path
+                piped = True
+            batch.append((a, source))
+
+        if len(batch) > 1:
+            if export_batch(batch, path, gain, debug):
+                return []
+            print(' ' * indent + "Couldn't export in one process, exporting "
+                  "one at a time")
+
+        return [a for a in files if not a.export(
+            path, gain, debug=debug,
+            source=self.path if a.data is None else None)]
+
     def export_combined(self, path):
         """Exports an audiofile that is all the imported audio combined.
 
@@ -0,0 +1,39 @@
+"""Measures how long each step of processing a song takes.
+
+Written by Clysop.
+"""
+
+import time
+import functools
+
+# Steps of processing that are timed, in the order they happen.
+#   probe:      reading stream info of audiofiles.
+#   decode:     loading audiofiles into memory.
+#   mix:        mixing and analyzing loaded audio.
+#   analyze:    decoding, mixing and analyzing at once, when streaming.
+#   encode:     exporting audiofiles with gain.
+#   copy:       copying files that aren't exported.
+STAGES = ('probe', 'decode', 'mix', 'analyze', 'encode', 'copy')
+
+
+def add(timings, stage, seconds):
+    """Adds 'seconds' to 'stage' in dict 'timings'."""
+    timings[stage] = timings.get(stage, 0.0) + seconds
+
+
+def timed(stage):
+    """Decorator adding the time a method takes to self.timings[stage].
+
+    Args:
+        stage (str):    name of step the method does, see STAGES.
+    """
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(self, *args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return func(self, *args, **kwargs)
+            finally:
+                add(self.timings, stage, time.perf_counter() - start)
+        return wrapper
+    return decorator
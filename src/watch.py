@@ -0,0 +1,274 @@
+"""Watches a folder for songs that are added or changed.
+
+Uses inotify on Linux, and polls the folder on other systems, or when
+inotify can't watch all folders.
+
+Written by Clysop.
+"""
+
+import os
+import time
+import errno
+import select
+import struct
+import ctypes
+import ctypes.util
+
+# Default seconds a folder must be left unchanged before it is processed.
+SETTLE_TIME = 3
+# Seconds between checks for changes.
+POLL_INTERVAL = 1
+
+# inotify event flags, from sys/inotify.h.
+IN_MODIFY = 0x00000002
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ISDIR = 0x40000000
+IN_CLOEXEC = 0o2000000
+
+# Events that change the files in a folder.
+WATCH_MASK = IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | \
+    IN_MOVED_TO | IN_CREATE | IN_DELETE
+# Header of an inotify event: wd, mask, cookie and length of name.
+EVENT_HEADER = struct.Struct('iIII')
+# Max number of bytes of events read at a time.
+EVENT_BUFFER_SIZE = 2 ** 16
+
+
+def watch(folder, settle=SETTLE_TIME, interval=POLL_INTERVAL):
+    """Finds folders in 'folder' whose files are added or changed.
+
+    A changed folder is only yielded once its files have stayed the same
+    for 'settle' seconds, so songs that are still being copied or
+    extracted aren't processed half done. A folder isn't yielded while a
+    folder inside it is still changing.
+
+    Args:
+        folder (str):       folder to watch, including its subfolders.
+        settle (float):     seconds a folder must be left unchanged.
+        interval (float):   max seconds between checks for changes.
+
+    Yields:
+        list: paths of changed folders, none of them inside another.
+    """
+    try:
+        watcher = InotifyWatcher(folder)
+    except (OSError, AttributeError, TypeError):
+        # No inotify on this system, or too many folders for it.
+        watcher = PollingWatcher(folder)
+
+    # Snapshot and time of last change of changed folders, by path.
+    pending = {}
+    try:
+        while True:
+            changed_paths = watcher.read(interval)
+            now = time.monotonic()
+            for path in changed_paths:
+                if path in pending:
+                    pending[path][1] = now
+                else:
+                    pending[path] = [snapshot(path), now]
+
+            settled = []
+            for path, (snap, changed) in list(pending.items()):
+                if now - changed < settle:
+                    continue
+
+                current = snapshot(path)
+                if current is None:
+                    # Folder was deleted.
+                    del pending[path]
+                elif current != snap:
+                    pending[path] = [current, now]
+                else:
+                    settled.append(path)
+
+            changing = [p for p in pending if p not in settled]
+            ready = [p for p in settled
+                     if not any(_inside(c, p) for c in changing)]
+            ready = [p for p in ready
+                     if not any(_inside(p, r) for r in ready)]
+
+            if len(ready) > 0:
+                for p in list(pending):
+                    if any(p == r or _inside(p, r) for r in ready):
+                        del pending[p]
+                yield ready
+    finally:
+        watcher.close()
+
+
+def snapshot(path):
+    """Returns the names and stats of files in 'path', None if it's gone."""
+    try:
+        with os.scandir(path) as entries:
+            return {e.name: (e.is_dir(), e.stat().st_size,
+                             e.stat().st_mtime_ns) for e in entries}
+    except OSError:
+        return None
+
+
+def _inside(path, folder):
+    """Returns True if 'path' is inside 'folder', but not 'folder' itself."""
+    return path.startswith(os.path.join(folder, ''))
+
+
+class InotifyWatcher():
+    """Class for finding changed folders using inotify.
+
+    Watches every folder in the watched folder, and folders as they are
+    added.
+
+    Raises:
+        OSError: if inotify isn't available, or can't watch every folder.
+    """
+
+    def __init__(self, folder):
+        self.folder = folder
+        self.paths = {}
+
+        self._libc = ctypes.CDLL(ctypes.util.find_library('c'),
+                                 use_errno=True)
+        self.fd = self._libc.inotify_init1(IN_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+
+        try:
+            self._add_tree(folder)
+        except OSError:
+            os.close(self.fd)
+            raise
+
+    def _add_tree(self, folder):
+        """Watches 'folder' and all folders in it.
+
+        Returns:
+            list: paths of all folders watched.
+        """
+        added = []
+        for dirpath, dirnames, filenames in os.walk(folder):
+            wd = self._libc.inotify_add_watch(
+                self.fd, os.fsencode(dirpath), WATCH_MASK)
+            if wd < 0:
+                error = ctypes.get_errno()
+                if error == errno.ENOENT:
+                    # Removed before it could be watched.
+                    continue
+                raise OSError(error, "Can't watch " + dirpath)
+
+            self.paths[wd] = dirpath
+            added.append(dirpath)
+
+        return added
+
+    def read(self, timeout):
+        """Waits up to 'timeout' seconds for changes.
+
+        Returns:
+            set: paths of folders that changed.
+        """
+        changed = set()
+        ready, _, _ = select.select([self.fd], [], [], timeout)
+        if not ready:
+            return changed
+
+        data = os.read(self.fd, EVENT_BUFFER_SIZE)
+        pos = 0
+        while pos < len(data):
+            wd, mask, cookie, length = EVENT_HEADER.unpack_from(data, pos)
+            name = data[pos + EVENT_HEADER.size:
+                        pos + EVENT_HEADER.size + length].rstrip(b'\0')
+            pos += EVENT_HEADER.size + length
+
+            if mask & IN_Q_OVERFLOW:
+                # Events were lost, check the whole folder.
+                changed.add(self.folder)
+            elif mask & IN_IGNORED:
+                self.paths.pop(wd, None)
+            elif wd in self.paths:
+                path = self.paths[wd]
+
+                # Folders being added or removed doesn't change the files
+                # of their parent.
+                if not mask & IN_ISDIR:
+                    changed.add(path)
+                elif mask & (IN_CREATE | IN_MOVED_TO):
+                    # Folders added whole, like when moved here, have no
+                    # events for what's already in them.
+                    try:
+                        changed.update(self._add_tree(
+                            os.path.join(path, os.fsdecode(name))))
+                    except OSError:
+                        # Out of watches, process the parent instead,
+                        # which finds the songs in the new folder.
+                        changed.add(path)
+
+        return changed
+
+    def close(self):
+        """Stops watching."""
+        os.close(self.fd)
+
+
+class PollingWatcher():
+    """Class for finding changed folders by checking them now and then.
+
+    Compares modification times of folders, which change when files are
+    added, removed or renamed in them. Files changed in place are found
+    once they are replaced, like most programs save files.
+    """
+
+    def __init__(self, folder):
+        self.folder = folder
+        self.folders = self._scan()
+
+    def _scan(self):
+        """Returns modification time, subfolders and files of every folder.
+
+        Returns:
+            dict: (mtime, subfolders, files) tuples, by path.
+        """
+        folders = {}
+        for dirpath, dirnames, filenames in os.walk(self.folder):
+            try:
+                mtime = os.stat(dirpath).st_mtime_ns
+            except OSError:
+                continue
+            folders[dirpath] = (mtime, frozenset(dirnames),
+                                frozenset(filenames))
+        return folders
+
+    def read(self, timeout):
+        """Waits 'timeout' seconds, then checks for changes.
+
+        Returns:
+            set: paths of folders whose files changed, or that were added.
+        """
+        time.sleep(timeout)
+
+        folders = self._scan()
+        changed = set()
+        for path, (mtime, dirnames, filenames) in folders.items():
+            if path not in self.folders:
+                changed.add(path)
+                continue
+
+            old_mtime, old_dirnames, old_filenames = self.folders[path]
+            # Folders being added or removed doesn't change the files of
+            # their parent.
+            if mtime != old_mtime and (dirnames == old_dirnames or
+                                       filenames != old_filenames):
+                changed.add(path)
+
+        self.folders = folders
+        return changed
+
+    def close(self):
+        """Stops watching."""
+        pass